@@ -1,9 +1,11 @@
 import argparse
 import logging
-import cPickle
 import sys
 import math
 from collections import defaultdict
+import numpy as np
+from ..models import batch_log_prob, pack_patterns
+from ..modelfile import load_model
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -17,25 +19,30 @@ def main():
     args = parser.parse_args()
 
     logging.info('Loading model')
-    with open(args.model) as model_file:
-        model = cPickle.load(model_file)
+    model = load_model(args.model)
 
     from ..analyzers import all_analyzers
     analyzer = all_analyzers[args.backend](args.analyzer)
 
-    def pattern_class(pattern):
-        if len(pattern) < 2:
-            return -1
-        return pattern[1]
-
     logging.info('#Patterns: %d', len(model.pattern_vocabulary))
+    # Class of a pattern: its first morpheme after the stem (-1 if it has none)
+    lengths, morphemes = pack_patterns(model.pattern_vocabulary)
+    heads = np.cumsum(lengths) - lengths
+    pattern_class = np.empty(len(lengths), dtype=np.int64)
+    pattern_class.fill(-1)
+    suffixed = lengths >= 2
+    pattern_class[suffixed] = morphemes[heads[suffixed] + 1]
+    pattern_lps = batch_log_prob(model.pattern_model, np.arange(len(model.pattern_vocabulary)))
+    # Keep the 10 most likely patterns of each class (START and STOP are not patterns)
+    patterns = np.flatnonzero(lengths > 0)
+    patterns = patterns[np.lexsort((-patterns, -pattern_lps[patterns], pattern_class[patterns]))]
+    classes = pattern_class[patterns]
+    starts = np.flatnonzero(np.concatenate(([True], classes[1:] != classes[:-1])))
+    rank = np.arange(len(patterns)) - np.repeat(starts, np.diff(np.append(starts, len(patterns))))
+    logging.info('#Pattern classes: %d', len(starts))
     pattern_classes = defaultdict(list)
-    for p, pattern in enumerate(model.pattern_vocabulary):
-        pattern_p = model.pattern_model.prob(p)
-        pattern_classes[pattern_class(pattern)].append((pattern_p, p))
-    logging.info('#Pattern classes: %d', len(pattern_classes))
-    for cl in pattern_classes:
-        pattern_classes[cl] = sorted(pattern_classes[cl], reverse=True)[:10]
+    for p in patterns[rank < 10].tolist():
+        pattern_classes[pattern_class[p]].append((pattern_lps[p], p))
     logging.info('After filtering: %d patterns', sum(map(len, pattern_classes.itervalues())))
 
     S = model.morpheme_vocabulary['__STEM__']
@@ -48,13 +55,13 @@ def main():
 
     def generate_alternatives(f, e):
         t_word = model.t_table[model.source_vocabulary[f]]
-        analyses = set((analysis.stem, pattern_class(model.pattern_vocabulary[analysis.pattern]))
+        analyses = set((analysis.stem, pattern_class[analysis.pattern])
                 for analysis in model.analyses[model.target_vocabulary[e]])
         for stem, cls in analyses:
-            stem_p = t_word.base.stem_model.prob(stem)
-            for pattern_p, pattern in pattern_classes[cls]:
+            stem_lp = math.log(t_word.base.stem_model.prob(stem))
+            for pattern_lp, pattern in pattern_classes[cls]:
                 for new_e in synthesize(stem, pattern):
-                    yield stem_p, pattern_p, new_e # PatternLength=len(pattern) ?
+                    yield stem_lp, pattern_lp, new_e # PatternLength=len(pattern) ?
 
     for line in sys.stdin:
         sys.stdout.write(line)
@@ -64,9 +71,9 @@ def main():
         if len(f) == len(e) == 1:
             f, e = f[0].decode('utf8'), e[0].decode('utf8')
             logging.info('Expading %s ||| %s', f, e)
-            for stem_p, pattern_p, new_e in generate_alternatives(f, e):
+            for stem_lp, pattern_lp, new_e in generate_alternatives(f, e):
                 print(u'{0} ||| {1} ||| {2} ||| StemProb={3} PatternProb={4} Alternative=1 ||| 0-0'.format(nt, f, new_e, 
-                    math.log(stem_p), math.log(pattern_p)).encode('utf8'))
+                    stem_lp, pattern_lp).encode('utf8'))
 
 if __name__ == '__main__':
     main()
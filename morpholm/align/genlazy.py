@@ -1,10 +1,11 @@
 import argparse
 import logging
-import cPickle
 import os
 import math
 from collections import defaultdict
 from itertools import groupby
+from ..modelfile import load_model
+from ..corpusfile import load_corpus
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -18,13 +19,11 @@ def main():
     args = parser.parse_args()
 
     logging.info('Loading model')
-    with open(args.model) as model_file:
-        model = cPickle.load(model_file)
+    model = load_model(args.model)
 
 
     logging.info('Reading large analyzed corpus')
-    with open(args.corpus) as corpus_file:
-        corpus = cPickle.load(corpus_file)
+    corpus = load_corpus(args.corpus)
 
     logging.info('Indexing analyzed words by stem')
     stem_patterns = defaultdict(dict)
@@ -1,9 +1,92 @@
 import logging
+import numpy as np
 from vpyp.align.model import AlignmentModel, AlignmentDistribution
 from vpyp.pyp import PYP
 from vpyp.prob import BetaBernouilli
 from vpyp.prior import GammaPrior, PYPPrior, stuple
-from ..models import MorphoProcess
+from ..models import MorphoProcess, AnalysisTable, ProbCache, cumsum_sample
+from ..models import seating, seating_delta, seating_log_likelihood, base_log_likelihood, \
+        chain_seating_log_likelihood, chain_prior_log_likelihood
+from ..parallel import resample_chains
+
+class TTable:
+    """Sparse t-table: the PYP(MP) chain of a source word is created on first
+    increment and reclaimed when it becomes empty; its hyperparameters are kept
+    in an array, and restored when the chain is created again. Reads of other
+    source words go to a shared empty chain, whose probabilities are those of
+    the base."""
+    def __init__(self, n_source, stem_base, pattern_model, analyses):
+        self.n_source = n_source
+        self.stem_base = stem_base
+        self.pattern_model = pattern_model
+        self.analyses = analyses
+        self.entries = {}
+        # d_w, theta_w, d_s, theta_s of each source word
+        self.hyperparameters = np.tile([0.1, 1.0, 0.1, 1.0], (n_source, 1))
+        self.empty = self.make_t_word()
+        self.reset_log_likelihood() # running log-likelihood of the live chains
+
+    def make_t_word(self, f=None):
+        stem_model = PYP(self.stem_base, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_s
+        mp = MorphoProcess(stem_model, self.pattern_model, self.analyses)
+        t_word = PYP(mp, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_w
+        if f is not None:
+            d_w, theta_w, d_s, theta_s = self.hyperparameters[f].tolist()
+            t_word.prior.d, t_word.prior.theta = d_w, theta_w
+            stem_model.prior.d, stem_model.prior.theta = d_s, theta_s
+        return t_word
+
+    def __getitem__(self, f):
+        return self.entries.get(f, self.empty)
+
+    def __len__(self):
+        return self.n_source
+
+    def __iter__(self):
+        return (self[f] for f in xrange(self.n_source))
+
+    def increment(self, f, e):
+        t_word = self.entries.get(f)
+        if t_word is None:
+            t_word = self.entries[f] = self.make_t_word(f)
+            t_word.base.track_ll_delta()
+            self.prior_ll += chain_prior_log_likelihood(t_word)
+        state = seating(t_word, e)
+        t_word.increment(e)
+        self.seating_ll += seating_delta(state, e) + t_word.base.take_ll_delta()
+
+    def decrement(self, f, e):
+        t_word = self.entries[f]
+        state = seating(t_word, e)
+        t_word.decrement(e)
+        self.seating_ll += seating_delta(state, e) + t_word.base.take_ll_delta()
+        if t_word.total_customers == 0:
+            stem_model = t_word.base.stem_model
+            self.hyperparameters[f] = (t_word.d, t_word.theta, stem_model.d, stem_model.theta)
+            self.prior_ll -= chain_prior_log_likelihood(t_word)
+            del self.entries[f]
+
+    def live(self):
+        return self.entries.itervalues()
+
+    def processes(self):
+        """MorphoProcesses of all the chains (they share one AnalysisTable)"""
+        return [self.empty.base] + [t_word.base for t_word in self.live()]
+
+    def log_likelihood(self):
+        """Log-likelihood of the live chains (G_w, G_s and their hyperparameters) and
+        seating terms of the shared bases (G_p, G_s^0 if it is a PYP); the seating terms
+        are updated in closed form by every increment and decrement"""
+        return self.seating_ll + self.prior_ll
+
+    def reset_log_likelihood(self):
+        """Recompute the running terms from scratch (after the hyperparameters change)"""
+        self.seating_ll = (sum(chain_seating_log_likelihood(t_word) for t_word in self.live())
+                + seating_log_likelihood(self.pattern_model) # G_p
+                + seating_log_likelihood(self.stem_base)) # G_s^0 if it is a PYP
+        self.prior_ll = sum(chain_prior_log_likelihood(t_word) for t_word in self.live())
+        for t_word in self.live():
+            t_word.base.track_ll_delta()
 
 class MorphoAlignmentModel(AlignmentModel):
     def __init__(self, n_source, stem_base, pattern_model, analyses):
@@ -16,40 +99,76 @@ class MorphoAlignmentModel(AlignmentModel):
         self.a_table = AlignmentDistribution(GammaPrior(1.0, 1.0, 4.0))
         self.stem_base = stem_base # G_s^0
         self.pattern_model = pattern_model
-        def make_t_word():
-            stem_model = PYP(stem_base, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_s
-            mp = MorphoProcess(stem_model, self.pattern_model, analyses)
-            return PYP(mp, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_w
-        self.t_table = [make_t_word() for _ in xrange(n_source)]
+        analyses = AnalysisTable(analyses) # shared by all source words
+        self.t_table = TTable(n_source, stem_base, pattern_model, analyses)
+
+    def link_probs(self, f, e, i):
+        """p(a_i = j) for j = 0 (NULL), 1..len(f)-1"""
+        m, n = len(e), len(f) - 1
+        probs = np.array([self.t_table[f_j].prob(e[i]) for f_j in f])
+        probs[0] *= self.p_null
+        probs[1:] *= (1 - self.p_null) * np.array([self.a_table.prob(i, j, m, n)
+            for j in xrange(1, n+1)])
+        return probs
+
+    def increment(self, f, e, i):
+        j = cumsum_sample(self.link_probs(f, e, i))
+        self.add_link(f, e, i, j)
+        return j
+
+    def add_link(self, f, e, i, j):
+        self.null.increment(j == 0)
+        if j > 0: self.a_table.increment(i, j, len(e), len(f) - 1)
+        self.t_table.increment(f[j], e[i])
+
+    def decrement(self, f, e, i, j):
+        self.null.decrement(j == 0)
+        if j > 0: self.a_table.decrement(i, j, len(e), len(f) - 1)
+        self.t_table.decrement(f[j], e[i])
 
     def log_likelihood(self):
-        return (sum((t_word.log_likelihood() # G_w
-                   + t_word.prior.log_likelihood() # d_w, T_w
-                   + t_word.base.stem_model.log_likelihood() # G_s
-                   + t_word.base.stem_model.prior.log_likelihood()) # d_s, T_s
-                    for t_word in self.t_table)
-                + self.pattern_model.log_likelihood(full=True) # G_p + ...
-                + self.stem_base.log_likelihood(full=True) # G_s^0 + ...
+        """Running log-likelihood: the t-table seating terms are updated in closed form
+        by every increment and decrement; the shared bases and priors are rescored"""
+        return (self.t_table.log_likelihood()
+                + base_log_likelihood(self.pattern_model) # d_p, T_p, G_p^0
+                + base_log_likelihood(self.stem_base) # G_s^0
                 + self.null.log_likelihood()
                 + self.a_table.log_likelihood() + self.a_table.scale_prior.log_likelihood())
 
-    def resample_hyperparemeters(self, n_iter):
+    def resample_hyperparemeters(self, n_iter, n_workers=1):
         ar = stuple((0, 0))
         logging.info('Resampling stem base / pattern model hyperparameters')
         ar += self.pattern_model.resample_hyperparemeters(n_iter) # G_p
         ar += self.pattern_model.base.resample_hyperparemeters(n_iter) # G_p^0
         ar += self.stem_base.resample_hyperparemeters(n_iter) # G_s^0
         logging.info('Resampling t-table word and stem hyperparameters')
-        for t_word in self.t_table:
-            ar += t_word.resample_hyperparemeters(n_iter) # G_w
-            ar += t_word.base.stem_model.resample_hyperparemeters(n_iter) # G_s
+        t_words = [self.t_table.entries[f] for f in sorted(self.t_table.entries)]
+        ar += resample_chains(t_words, n_iter, n_workers) # G_w, G_s
+        ProbCache.invalidate()
         logging.info('Resampling alignment distribution scale parameter')
         ar += self.a_table.resample_hyperparemeters(n_iter)
+        self.t_table.reset_log_likelihood()
         return ar
 
+    def full_log_likelihood(self):
+        """Recompute the log-likelihood from scratch"""
+        self.t_table.reset_log_likelihood()
+        return self.log_likelihood()
+
     def __repr__(self):
         return ('MorphoAlignmentModel(#source words={n_source} '
-                '| t-table[f] ~ PYP(base=MP(stem ~ PYP(base={self.stem_base}); '
+                '| t-table[f] ~ {n_live} x PYP(base=MP(stem ~ PYP(base={self.stem_base}); '
                 'pattern ~ {self.pattern_model}))'
                 '| a-table ~ {self.a_table} + p(NULL)={self.p_null} ~ {self.null})'
-                ).format(self=self, n_source=len(self.t_table))
+                ).format(self=self, n_source=len(self.t_table),
+                        n_live=len(self.t_table.entries))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.t_table, list): # legacy dense t-table
+            t_table = self.t_table
+            analyses = t_table[0].base.table
+            self.t_table = TTable(len(t_table), self.stem_base, self.pattern_model, analyses)
+            self.t_table.entries = dict((f, t_word) for f, t_word in enumerate(t_table)
+                    if t_word.total_customers > 0)
+            self.t_table.reset_log_likelihood()
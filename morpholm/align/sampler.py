@@ -0,0 +1,89 @@
+import logging
+import math
+import random
+import numpy as np
+from ..models import prune_analyses
+from ..parallel import make_shards, fork_map
+
+mh_iter = 100
+
+def sample_sentence(model, f, e, links, resample):
+    for i in xrange(len(e)):
+        if resample: model.decrement(f, e, i, int(links[i]))
+        links[i] = model.increment(f, e, i)
+
+def _sample_shard(state, shard):
+    model, corpus, offsets, alignments = state
+    start, end = shard
+    base = offsets[start]
+    new_alignments = alignments[base:offsets[end]].copy()
+    for s in xrange(start, end):
+        f, e = corpus[s]
+        sample_sentence(model, f, e,
+                new_alignments[offsets[s]-base:offsets[s+1]-base], True)
+    return new_alignments
+
+def parallel_sweep(model, corpus, offsets, alignments, n_workers):
+    """Each worker samples a shard of sentence pairs against a snapshot of the
+    model; changed links are then replayed on the shared t-table, a-table,
+    pattern model and stem base"""
+    shards = make_shards(offsets, n_workers)
+    results = fork_map(_sample_shard, (model, corpus, offsets, alignments), shards,
+            random.randrange(2**31))
+    n_changed = 0
+    for (start, end), new_alignments in zip(shards, results):
+        base = offsets[start]
+        for s in xrange(start, end):
+            f, e = corpus[s]
+            old = alignments[offsets[s]:offsets[s+1]]
+            new = new_alignments[offsets[s]-base:offsets[s+1]-base]
+            for i in np.flatnonzero(old != new):
+                model.decrement(f, e, i, int(old[i]))
+                model.add_link(f, e, i, int(new[i]))
+            n_changed += np.count_nonzero(old != new)
+            old[:] = new
+    logging.info('Merged %d link changes from %d shards', n_changed, len(shards))
+
+def log_progress(model, n_tokens, check):
+    ll = model.log_likelihood()
+    ppl = math.exp(-ll / n_tokens)
+    logging.info('LL=%.0f ppl=%.3f', ll, ppl)
+    if check:
+        full_ll = model.full_log_likelihood()
+        logging.info('Full LL=%.0f (running LL error: %.3g)', full_ll, ll - full_ll)
+
+def trace_values(model):
+    """Quantities compared across chains by the convergence diagnostics"""
+    return {'LL': model.log_likelihood(), 'p_null': model.p_null,
+            'pattern_d': model.pattern_model.d, 'pattern_theta': model.pattern_model.theta}
+
+def run_sampler(model, corpus, n_iter, cb=None, n_workers=1, prune=0, burn_in=0,
+        ll_interval=10, ll_check=False, start=0, alignments=None, checkpoint=None):
+    offsets = np.zeros(len(corpus)+1, dtype=np.int64)
+    np.cumsum([len(e) for f, e in corpus], out=offsets[1:])
+    n_tokens = int(offsets[-1])
+    if alignments is None:
+        alignments = np.zeros(n_tokens, dtype=np.int32)
+    for it in xrange(start, n_iter):
+        logging.info('Iteration %d/%d', it+1, n_iter)
+        if it == 0 or n_workers == 1:
+            for s, (f, e) in enumerate(corpus):
+                sample_sentence(model, f, e, alignments[offsets[s]:offsets[s+1]], it > 0)
+        else:
+            parallel_sweep(model, corpus, offsets, alignments, n_workers)
+        if prune and it == burn_in - 1:
+            before, after = prune_analyses(model.t_table.processes(), prune)
+            logging.info('Pruned analyses with posterior < %g: %.2f -> %.2f per word',
+                    prune, before, after)
+        if ll_interval and it % ll_interval == ll_interval - 1:
+            log_progress(model, n_tokens, ll_check)
+            logging.info('Model: %s', model)
+        if it % 30 == 29:
+            logging.info('Resampling hyperparameters...')
+            acceptance, rejection = model.resample_hyperparemeters(mh_iter, n_workers)
+            arate = acceptance / float(acceptance + rejection)
+            logging.info('Metropolis-Hastings acceptance rate: %.4f', arate)
+            logging.info('Model: %s', model)
+        if checkpoint: checkpoint(it+1, model, alignments=alignments)
+        if cb and cb(it): break
+    return [alignments[offsets[s]:offsets[s+1]].tolist() for s in xrange(len(corpus))]
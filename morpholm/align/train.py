@@ -1,3 +1,4 @@
+import os
 import argparse
 import logging
 import cPickle
@@ -7,36 +8,16 @@ from vpyp.prob import Uniform
 from vpyp.charlm import CharLM
 from vpyp.prior import PYPPrior, GammaPrior
 from vpyp.pyp import PYP
-from vpyp.align.train import run_sampler
 from ..models import BigramPattern, PoissonUnigramPattern, UniformUnigramPattern
 from model import MorphoAlignmentModel
+from ..chains import run_chains
+from ..checkpoint import Checkpoint, load_checkpoint
+from ..corpusfile import load_corpus
+from sampler import run_sampler, trace_values
 
 NULL = '__NULL__'
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(message)s')
-
-    parser = argparse.ArgumentParser(description='Train MP alignment model')
-    parser.add_argument('--source', '-f', help='source corpus', required=True)
-    parser.add_argument('--target', '-e', help='target analyzed corpus', required=True)
-    parser.add_argument('--iter', help='number of iterations', type=int, required=True)
-    parser.add_argument('--charlm', help='character language model')
-    parser.add_argument('--pyp', help='G_w^0 is PYP(CharLM)', action='store_true')
-    parser.add_argument('--model', help='model type', type=int, default=0)
-    parser.add_argument('--output', help='model output path')
-
-    args = parser.parse_args()
-
-    logging.info('Reading parallel training data')
-    with open(args.source) as source:
-        source_corpus = Corpus(source)
-    with open(args.target) as target:
-        target_corpus = cPickle.load(target)
-    assert len(source_corpus.segments) == len(target_corpus.segments)
-    N = source_corpus.vocabulary[NULL]
-    training_corpus = [([N]+f, e) for f, e in izip(source_corpus, target_corpus)]
-    logging.info('Read %d sentences', len(training_corpus))
-
+def build_model(args, source_corpus, target_corpus):
     if args.charlm:
         logging.info('Preloading stem character language model')
         char_lm = CharLM(args.charlm, target_corpus.stem_vocabulary)
@@ -65,21 +46,110 @@ def main():
     pattern_model = PYP(pattern_base, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_p
 
     n_source = len(source_corpus.vocabulary)
-    model = MorphoAlignmentModel(n_source, stem_base, pattern_model, target_corpus.analyses)
-
-    logging.info('Training alignment model')
-    alignments = run_sampler(model, training_corpus, args.iter)
-
-    if args.output:
-        with open(args.output, 'w') as f:
-            model.source_vocabulary = source_corpus.vocabulary
-            model.target_vocabulary = target_corpus.vocabulary
-            model.stem_vocabulary = target_corpus.stem_vocabulary
-            model.morpheme_vocabulary = target_corpus.morpheme_vocabulary
-            model.pattern_vocabulary = target_corpus.pattern_vocabulary
-            model.analyses = target_corpus.analyses
+    return MorphoAlignmentModel(n_source, stem_base, pattern_model, target_corpus.analyses)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Train MP alignment model')
+    parser.add_argument('--source', '-f', help='source corpus', required=True)
+    parser.add_argument('--target', '-e', help='target analyzed corpus', required=True)
+    parser.add_argument('--iter', help='number of iterations', type=int, required=True)
+    parser.add_argument('--charlm', help='character language model')
+    parser.add_argument('--pyp', help='G_w^0 is PYP(CharLM)', action='store_true')
+    parser.add_argument('--model', help='model type', type=int, default=0)
+    parser.add_argument('--output', help='model output path')
+    parser.add_argument('--ll-interval', help='log the log-likelihood every N iterations'
+            ' (0: never)', type=int, default=10)
+    parser.add_argument('--ll-check', help='check the running log-likelihood against'
+            ' a full recomputation', action='store_true')
+    parser.add_argument('--prune', help='after burn-in, drop analyses with a posterior'
+            ' below this threshold', type=float, default=0)
+    parser.add_argument('--burn-in', help='number of iterations before pruning', type=int,
+            default=100)
+    parser.add_argument('--jobs', help='number of parallel sampling processes',
+            type=int, default=1)
+    parser.add_argument('--chains', help='number of independent chains run in parallel'
+            ' (the best one is kept)', type=int, default=1)
+    parser.add_argument('--rhat', help='stop the chains when the R-hat of all traced'
+            ' quantities is below this value', type=float, default=1.1)
+    parser.add_argument('--min-ess', help='but not before the effective sample size of'
+            ' the log-likelihood reaches this value', type=float, default=100)
+    parser.add_argument('--checkpoint', help='periodically save the sampler state to this'
+            ' path')
+    parser.add_argument('--checkpoint-interval', help='minutes between checkpoints',
+            type=float, default=5)
+    parser.add_argument('--resume', help='continue training from the checkpoint',
+            action='store_true')
+
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    if args.checkpoint and args.chains > 1:
+        parser.error('--checkpoint cannot be used with --chains')
+
+    logging.info('Reading parallel training data')
+    with open(args.source) as source:
+        source_corpus = Corpus(source)
+    target_corpus = load_corpus(args.target)
+    assert len(source_corpus.segments) == len(target_corpus.segments)
+    N = source_corpus.vocabulary[NULL]
+    training_corpus = [([N]+f, e) for f, e in izip(source_corpus, target_corpus)]
+    logging.info('Read %d sentences', len(training_corpus))
+
+    # The model holds the vocabularies and analyses its t-table uses, so that they
+    # are saved and checkpointed with it (pruning changes the analyses)
+    attributes = (('source_vocabulary', source_corpus, 'vocabulary'),
+            ('target_vocabulary', target_corpus, 'vocabulary'),
+            ('stem_vocabulary', target_corpus, 'stem_vocabulary'),
+            ('morpheme_vocabulary', target_corpus, 'morpheme_vocabulary'),
+            ('pattern_vocabulary', target_corpus, 'pattern_vocabulary'),
+            ('analyses', target_corpus, 'analyses'))
+    if args.resume:
+        state = load_checkpoint(args.checkpoint)
+        model = state['model']
+        start, alignments = state['iteration'], state['alignments']
+        for name, corpus, corpus_name in attributes:
+            setattr(corpus, corpus_name, getattr(model, name))
+    else:
+        model = build_model(args, source_corpus, target_corpus)
+        start, alignments = 0, None
+        for name, corpus, corpus_name in attributes:
+            setattr(model, name, getattr(corpus, corpus_name))
+
+    def save(path):
+        with open(path, 'w') as f:
             cPickle.dump(model, f, protocol=-1)
 
+    def train_chain(chain, report):
+        alignments = run_sampler(model, training_corpus, args.iter,
+                cb=lambda it: report(it, trace_values(model)), n_workers=args.jobs,
+                prune=args.prune, burn_in=args.burn_in,
+                ll_interval=args.ll_interval, ll_check=args.ll_check)
+        if args.output:
+            save('{0}.chain{1}'.format(args.output, chain))
+        return model.log_likelihood(), alignments
+
+    if args.chains > 1:
+        logging.info('Training %d alignment chains (%d jobs each)', args.chains, args.jobs)
+        results = run_chains(train_chain, args.chains, args.rhat, args.min_ess)
+        best = max(xrange(args.chains), key=lambda chain: results[chain][0])
+        logging.info('Keeping chain %d (LL=%.0f)', best, results[best][0])
+        alignments = results[best][1]
+        if args.output:
+            os.rename('{0}.chain{1}'.format(args.output, best), args.output)
+    else:
+        checkpoint = (Checkpoint(args.checkpoint, args.checkpoint_interval * 60)
+                if args.checkpoint else None)
+        logging.info('Training alignment model (%d jobs)', args.jobs)
+        alignments = run_sampler(model, training_corpus, args.iter, n_workers=args.jobs,
+                prune=args.prune, burn_in=args.burn_in,
+                ll_interval=args.ll_interval, ll_check=args.ll_check,
+                start=start, alignments=alignments, checkpoint=checkpoint)
+        if checkpoint: checkpoint.wait()
+        if args.output:
+            save(args.output)
+
     for a, (f, e) in izip(alignments, training_corpus):
         #f_sentence = ' '.join(source_corpus.vocabulary[w] for w in f[1:])
         #e_sentence = ' '.join(target_corpus.vocabulary[w] for w in e)
@@ -3,6 +3,7 @@ import logging
 import argparse
 import cPickle
 from vpyp.corpus import Corpus
+from corpusfile import save_corpus
 
 def load_analyses(corpus, model):
     corpus.stem_vocabulary = model.stem_vocabulary
@@ -18,10 +19,15 @@ def main():
     parser.add_argument('--backend', help='analyzer backend (foma/xfst/pymorphy/xerox)',
             default='foma')
     parser.add_argument('--analyzer', help='analyzer option', required=True)
+    parser.add_argument('--cache', help='persistent analysis cache (SQLite database)')
+    parser.add_argument('--jobs', help='number of parallel analysis processes',
+            type=int, default=1)
     parser.add_argument('--addnull', help='add null analysis', action='store_true')
     parser.add_argument('--rmnull', help='remove null analysis', action='store_true')
     parser.add_argument('--output', help='analyzed output path', required=True)
     parser.add_argument('--model', help='re-use vocabularies from this model')
+    parser.add_argument('--columnar', help='write the memory-mapped columnar format'
+            ' (a directory) instead of a pickle', action='store_true')
 
     args = parser.parse_args()
 
@@ -40,18 +46,23 @@ def main():
     n_types = len(corpus.vocabulary)
     logging.info('Number of tokens: %d / types: %d', n_tokens, n_types)
 
-    from analyzers import all_analyzers
-    analyzer = all_analyzers[args.backend](args.analyzer)
+    from analyzers import load_analyzer
+    analyzer = load_analyzer(args.backend, args.analyzer, args.cache, args.jobs)
     logging.info('Analyzing corpus using %s', analyzer)
     analyzer.analyze_corpus(corpus, args.addnull, args.rmnull)
+    if analyzer.cache:
+        analyzer.cache.log_stats()
     logging.info('Found %d morphemes / %d stems / %d analyses -> %d patterns',
             len(corpus.morpheme_vocabulary), len(corpus.stem_vocabulary),
             sum(len(analyses) for analyses in corpus.analyses.itervalues()),
             len(corpus.pattern_vocabulary))
 
     logging.info('Saving analyzed corpus')
-    with open(args.output, 'w') as out:
-        cPickle.dump(corpus, out, protocol=-1)
+    if args.columnar:
+        save_corpus(corpus, args.output)
+    else:
+        with open(args.output, 'w') as out:
+            cPickle.dump(corpus, out, protocol=-1)
 
 if __name__ == '__main__':
     main()
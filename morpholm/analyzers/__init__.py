@@ -1,8 +1,10 @@
 import logging
 from analyzer import Analyzer
+from cache import AnalysisCache
 
 class FomaAnalyzer(Analyzer):
     def __init__(self, fsm):
+        self.option = fsm
         self.fsm = foma.read_binary(fsm)
 
     def analyze_word(self, word):
@@ -13,6 +15,7 @@ class FomaAnalyzer(Analyzer):
 
 class XFSTAnalyzer(Analyzer):
     def __init__(self, fsm):
+        self.option = fsm
         self.fsm = xfst.read_binary(fsm)
 
     def analyze_word(self, word):
@@ -49,3 +52,12 @@ try:
     all_analyzers['xerox'] = XeroxAnalyzer
 except ImportError:
     logging.info('xerox backend not available')
+
+def load_analyzer(backend, option, cache=None, jobs=1):
+    """Create the analyzer of the given backend, consulting the analysis cache
+    stored at path cache if any, and analyzing new words in jobs processes"""
+    analyzer = all_analyzers[backend](option)
+    if cache:
+        analyzer.cache = AnalysisCache(cache, backend, option)
+    analyzer.jobs = jobs
+    return analyzer
@@ -1,6 +1,8 @@
 import re
 import logging
+import multiprocessing
 from vpyp.corpus import Vocabulary, OOV
+from patterns import PatternVocabulary
 
 word_re = re.compile('^[^\W\d_]+$', re.UNICODE)
 morph_re = re.compile('[A-Z]')
@@ -41,20 +43,68 @@ class Analysis(object):
     def __hash__(self):
         return hash((self.stem, self.pattern))
 
+def _unicode(analysis):
+    return analysis.decode('utf8') if isinstance(analysis, str) else analysis
+
+def raw_analyses(analyzer, word):
+    return sorted(set(map(_unicode, analyzer.analyze_word(word))))
+
+# Analyzer of a worker process, loaded once when the worker starts
+_worker = None
+
+def _init_worker(cls, option):
+    global _worker
+    _worker = cls(option)
+
+def _analyze_word(word):
+    return raw_analyses(_worker, word)
+
 class Analyzer(object):
+    cache = None # AnalysisCache consulted before analyzing words
+    option = None # constructor argument, to load the analyzer in worker processes
+    jobs = 1 # number of analysis processes
+
+    def analyze_new(self, words):
+        """-> {word: sorted raw analyses} for words not found in the cache"""
+        if self.jobs > 1 and self.option is not None and len(words) > self.jobs:
+            return self.analyze_parallel(words)
+        return dict((word, raw_analyses(self, word)) for word in words)
+
+    def analyze_parallel(self, words):
+        """Analyze words in self.jobs processes which each load the analyzer;
+        results come back in the order of words"""
+        pool = multiprocessing.Pool(self.jobs, _init_worker, (type(self), self.option))
+        try:
+            chunksize = max(1, len(words) // (4 * self.jobs))
+            return dict(zip(words, pool.map(_analyze_word, words, chunksize)))
+        finally:
+            pool.terminate()
+
+    def analyze_words(self, words):
+        """-> {word: raw analyses}, only analyzing the words missing from the cache"""
+        if self.cache is None:
+            return self.analyze_new(words)
+        analyses = self.cache.get_many(words)
+        new = self.analyze_new([word for word in words if word not in analyses])
+        self.cache.put_many(new.iteritems())
+        analyses.update(new)
+        return analyses
+
     def analyze_corpus(self, corpus, add_null=False, rm_null=False):
         if not hasattr(corpus, 'analyses'): # Pre-analyzed corpus
             corpus.analyses = {}
             corpus.stem_vocabulary = Vocabulary()
             corpus.morpheme_vocabulary = Vocabulary()
-            corpus.pattern_vocabulary = Vocabulary()
+            corpus.pattern_vocabulary = PatternVocabulary()
         if not rm_null:
             null_pattern = corpus.pattern_vocabulary[(corpus.morpheme_vocabulary[STEM],)]
-        for w, word in enumerate(corpus.vocabulary):
-            if w in corpus.analyses: continue # Skip already analyzed words
+        # Skip already analyzed words
+        words = [(w, word) for w, word in enumerate(corpus.vocabulary) if w not in corpus.analyses]
+        raw_analyses = self.analyze_words([word for _, word in words if word_re.match(word)])
+        for w, word in words:
             analyses = []
-            if word_re.match(word):
-                for analysis in self.analyze_word(word):
+            if word in raw_analyses:
+                for analysis in raw_analyses[word]:
                     try:
                         stem, pattern = parse_analysis(analysis)
                     except AnalysisError as e:
@@ -0,0 +1,79 @@
+"""Persistent cache of raw analyses
+
+Analyses are stored in an SQLite database, keyed by the backend and the content
+hash of the analyzer (the FST binary, or the option itself when it is not a
+file, e.g. a language), so that a cache is never reused with another analyzer."""
+import os
+import json
+import hashlib
+import sqlite3
+import logging
+import threading
+
+BATCH = 500 # SQLite limits the number of parameters of a query
+
+def analyzer_key(backend, option):
+    """-> backend:sha1 of the analyzer file (or of the option if it is not a file)"""
+    digest = hashlib.sha1()
+    if os.path.isfile(option):
+        with open(option, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                digest.update(block)
+    else:
+        digest.update(option.encode('utf8') if isinstance(option, unicode) else option)
+    return '{0}:{1}'.format(backend, digest.hexdigest())
+
+class AnalysisCache:
+    """word -> raw analyses of one analyzer, with hit/miss statistics"""
+    def __init__(self, path, backend, option):
+        self.path = path
+        self.key = analyzer_key(backend, option)
+        # One connection shared by the threads serving vis requests, used under a lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS analyses (analyzer TEXT, word TEXT,'
+                    ' analyses TEXT, PRIMARY KEY (analyzer, word))')
+        self.hits = self.misses = self.added = 0
+
+    def get_many(self, words):
+        """-> {word: analyses} for the words found in the cache"""
+        words = list(words)
+        found = {}
+        with self.lock:
+            for i in xrange(0, len(words), BATCH):
+                batch = words[i:i+BATCH]
+                query = ('SELECT word, analyses FROM analyses WHERE analyzer = ?'
+                        ' AND word IN ({0})'.format(','.join('?' * len(batch))))
+                for word, analyses in self.db.execute(query, [self.key] + batch):
+                    found[word] = json.loads(analyses)
+            self.hits += len(found)
+            self.misses += len(words) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Store (word, analyses) pairs"""
+        rows = [(self.key, word, json.dumps(list(analyses))) for word, analyses in items]
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?)', rows)
+            self.added += len(rows)
+
+    def get(self, word):
+        return self.get_many((word,)).get(word)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM analyses WHERE analyzer = ?',
+                    (self.key,)).fetchone()[0]
+
+    def log_stats(self):
+        logging.info('Analysis cache %s: %d hits / %d misses, %d words added (%d cached)',
+                self.path, self.hits, self.misses, self.added, len(self))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __repr__(self):
+        return 'AnalysisCache({self.path}, {self.key})'.format(self=self)
@@ -0,0 +1,123 @@
+"""Packed pattern vocabulary
+
+The morpheme sequences of all the patterns are stored in one int32 array with
+offsets, and looked up through an open-addressing hash table of pattern ids,
+instead of keeping a tuple per pattern and a dict from tuples to ids."""
+import numpy as np
+from vpyp.corpus import Vocabulary, OOV
+
+RESERVED = tuple(Vocabulary()) # START and STOP entries of a vpyp Vocabulary
+
+class PatternVocabulary(object):
+    """Vocabulary of patterns (tuples of morpheme ids): pattern p is
+    morphemes[offsets[p]:offsets[p+1]]. The reserved START and STOP entries are
+    empty in the arrays. The arrays may be read-only (memory-mapped); they are
+    copied when a new pattern is added. The hash table is only built when a
+    pattern is looked up."""
+    def __init__(self, offsets=None, morphemes=None, frozen=False):
+        if offsets is None:
+            offsets = np.zeros(len(RESERVED)+1, dtype=np.int64)
+            morphemes = np.zeros(0, dtype=np.int32)
+        self._offsets = offsets
+        self._morphemes = morphemes
+        self.size = len(offsets) - 1
+        self.frozen = frozen
+        self._index = None
+
+    def packed(self):
+        """-> (offsets, morphemes) of all the patterns, without copy"""
+        return self._offsets[:self.size+1], self._morphemes[:self._offsets[self.size]]
+
+    def morphemes(self, p):
+        """-> morphemes of pattern p, without copy"""
+        return self._morphemes[self._offsets[p]:self._offsets[p+1]]
+
+    @property
+    def index(self):
+        """Hash table of the pattern ids (-1: empty slot), at most half full"""
+        if self._index is None:
+            self._build_index()
+        return self._index
+
+    def _build_index(self):
+        self._index = np.empty(1 << (2 * self.size).bit_length(), dtype=np.int32)
+        self._index.fill(-1)
+        for p in xrange(len(RESERVED), self.size):
+            self._index[self._slot(self[p])] = p
+
+    def _slot(self, pattern):
+        """-> slot of the index holding the id of pattern, or the empty slot
+        where it goes (linear probing)"""
+        index = self.index
+        mask = len(index) - 1
+        i = hash(pattern) & mask
+        p = index[i]
+        while p >= 0 and tuple(self.morphemes(p).tolist()) != pattern:
+            i = (i + 1) & mask
+            p = index[i]
+        return i
+
+    def _append(self, pattern):
+        start = self._offsets[self.size]
+        end = start + len(pattern)
+        if (self.size + 2 > len(self._offsets) or end > len(self._morphemes)
+                or not self._offsets.flags.writeable):
+            offsets = np.zeros(max(2 * len(self._offsets), self.size + 2), dtype=np.int64)
+            offsets[:self.size+1] = self._offsets[:self.size+1]
+            morphemes = np.zeros(max(2 * len(self._morphemes), end), dtype=np.int32)
+            morphemes[:start] = self._morphemes[:start]
+            self._offsets, self._morphemes = offsets, morphemes
+        self._morphemes[start:end] = pattern
+        self.size += 1
+        self._offsets[self.size] = end
+        return self.size - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0: key += self.size
+            if not 0 <= key < self.size: raise IndexError(key)
+            if key < len(RESERVED):
+                return RESERVED[key]
+            return tuple(self.morphemes(key).tolist())
+        if key in RESERVED:
+            return RESERVED.index(key)
+        key = tuple(key)
+        i = self._slot(key)
+        p = int(self.index[i])
+        if p >= 0:
+            return p
+        if self.frozen: raise OOV(key)
+        p = self._append(key)
+        if 2 * self.size > len(self.index):
+            self._build_index()
+        else:
+            self.index[i] = p
+        return p
+
+    def __contains__(self, key):
+        return key in RESERVED or self.index[self._slot(tuple(key))] >= 0
+
+    def update(self, other):
+        for pattern in other:
+            self[pattern]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        offsets, morphemes = self.packed()
+        offsets, morphemes = offsets.tolist(), morphemes.tolist()
+        for p in xrange(self.size):
+            yield RESERVED[p] if p < len(RESERVED) else tuple(morphemes[offsets[p]:offsets[p+1]])
+
+    def __getstate__(self):
+        offsets, morphemes = self.packed()
+        return {'offsets': np.array(offsets), 'morphemes': np.array(morphemes),
+                'frozen': self.frozen}
+
+    def __setstate__(self, state):
+        self.__init__(state['offsets'], state['morphemes'], state['frozen'])
+
+    def __repr__(self):
+        return 'PatternVocabulary(#patterns={0}, #morphemes={1})'.format(self.size,
+                self._offsets[self.size])
@@ -5,7 +5,7 @@ import json
 import lxml.html
 from itertools import izip
 import logging
-from analyzer import Analyzer, word_re
+from analyzer import Analyzer
 
 supported_languages = {'cs': 'Czech', 'en': 'English', 'fr': 'French', 
 'de': 'German', 'el': 'Greek', 'hu': 'Hungarian', 'it': 'Italian', 
@@ -34,14 +34,12 @@ class XeroxAnalyzer(Analyzer):
         if not language in supported_languages:
             raise NotImplemented('No analyzer available for {0}'.format(language))
         self.language = supported_languages[language]
+        self.analyses = {} # all the analyses retrieved so far
 
-    def analyze_corpus(self, corpus, add_null=False, rm_null=False):
-        self.analyses = {}
-        # Get analyses for all words in the vocabulary not already analyzed
-        exclude = ({} if not hasattr(corpus, 'analyses') 
-                else set(corpus.vocabulary[w] for w in corpus.analyses))
-        analyzable = sorted(word for word in corpus.vocabulary 
-                if word_re.match(word) and word not in exclude)
+    def analyze_new(self, words):
+        # Request the analyses of the words not found in the cache
+        analyses = {}
+        analyzable = sorted(words)
         logging.info('Retrieving analyses for %d words', len(analyzable))
         for block in get_blocks(iter(analyzable), 1000):
             words = ' '.join(block)
@@ -70,19 +68,24 @@ class XeroxAnalyzer(Analyzer):
             ul_it = iter(doc.cssselect('body > ul')[0])
             for li, ul in izip(ul_it, ul_it):
                 word = li[0].text
-                analyses = [ali[0].text.lower()+fix_analysis(ali[1].text) for ali in ul]
-                self.analyses[word] = analyses
+                analyses[word] = sorted(set(ali[0].text.lower()+fix_analysis(ali[1].text)
+                    for ali in ul))
 
             wait = random.random() * 2 * WAIT
             logging.info('Sleep during %.3f s', wait)
             time.sleep(wait)
 
-        logging.info('Retrieved %d analyses', len(self.analyses))
-        if len(self.analyses) != len(analyzable):
+        logging.info('Retrieved %d analyses', len(analyses))
+        if len(analyses) != len(analyzable):
             logging.warn('|analyses| != |analyzable|: some analyses might be missing')
-        super(XeroxAnalyzer, self).analyze_corpus(corpus, add_null, rm_null)
+        self.analyses.update(analyses)
+        return analyses
 
     def analyze_word(self, word):
+        # No request per word: words must be retrieved in blocks by analyze_words
+        # (as analyze_corpus does); others are looked up in the cache only
+        if word not in self.analyses and self.cache is not None:
+            self.analyses.update(self.cache.get_many((word,)))
         return self.analyses.get(word, (word, ))
 
     def __repr__(self):
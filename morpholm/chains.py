@@ -0,0 +1,100 @@
+import logging
+import random
+import traceback
+import multiprocessing
+import numpy as np
+
+def split_rhat(x):
+    """Split-chain potential scale reduction factor of x[chain, iteration]"""
+    n = x.shape[1] // 2
+    x = np.vstack((x[:, :n], x[:, -n:]))
+    W = x.var(axis=1, ddof=1).mean()
+    B = n * x.mean(axis=1).var(ddof=1)
+    if W == 0:
+        return 1.0 if B == 0 else float('inf')
+    return float(np.sqrt(((n - 1.0) / n * W + B / n) / W))
+
+def effective_sample_size(x):
+    """Effective sample size of x[chain, iteration], with Geyer's initial positive
+    sequence estimator on the autocorrelation averaged across chains"""
+    m, n = x.shape
+    x = x - x.mean(axis=1)[:, np.newaxis]
+    var = (x * x).mean()
+    if var == 0:
+        return float(m * n)
+    rho = np.array([(x[:, :n-t] * x[:, t:]).sum() / (m * n * var) for t in xrange(n)])
+    tau = -1.0
+    for t in xrange(0, n - 1, 2):
+        pair = rho[t] + rho[t+1]
+        if pair < 0: break
+        tau += 2 * pair
+    return float(m * n / max(tau, 1e-12))
+
+def diagnostics(traces):
+    """traces[chain] = list of {name: value} -> {name: (R-hat, ESS)} over the second
+    half of the common length of the chains"""
+    t = min(len(trace) for trace in traces)
+    diag = {}
+    for name in traces[0][0]:
+        x = np.array([[values[name] for values in trace[t//2:t]] for trace in traces])
+        diag[name] = (split_rhat(x), effective_sample_size(x))
+    return diag
+
+def _chain_main(train, chain, seed, queue, stop):
+    random.seed(seed)
+    np.random.seed(seed)
+    def report(it, values):
+        queue.put(('trace', chain, values))
+        return stop.is_set()
+    try:
+        result = train(chain, report)
+    except Exception:
+        queue.put(('error', chain, traceback.format_exc()))
+        return
+    queue.put(('done', chain, result))
+
+def run_chains(train, n_chains, max_rhat=1.1, min_ess=100, check_every=10, min_iter=20):
+    """Run train(chain, report) in n_chains forked processes with different seeds.
+    train calls report(it, values) after each iteration with a dict of the traced
+    quantities ('LL' and hyperparameters), and stops when it returns True: this
+    happens once R-hat < max_rhat for all of them and the ESS of the log-likelihood
+    is >= min_ess (hyperparameters only move every few iterations, so their ESS is
+    logged but not required) -> [result of train for each chain]"""
+    queue = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    seed = random.randrange(2**31)
+    processes = [multiprocessing.Process(target=_chain_main,
+        args=(train, chain, seed + chain, queue, stop)) for chain in xrange(n_chains)]
+    for process in processes:
+        process.start()
+    traces = [[] for _ in xrange(n_chains)]
+    results = [None] * n_chains
+    checked = 0
+    n_done = 0
+    try:
+        while n_done < n_chains:
+            message, chain, payload = queue.get()
+            if message == 'error':
+                raise RuntimeError('Chain {0} failed:\n{1}'.format(chain, payload))
+            if message == 'done':
+                results[chain] = payload
+                n_done += 1
+                continue
+            traces[chain].append(payload)
+            t = min(len(trace) for trace in traces)
+            if t == checked or t < min_iter or t % check_every or stop.is_set():
+                continue
+            checked = t
+            diag = diagnostics(traces)
+            logging.info('Chain diagnostics after %d iterations: %s', t,
+                    ', '.join('{0}: R-hat={1:.3f} ESS={2:.0f}'.format(name, rhat, ess)
+                        for name, (rhat, ess) in sorted(diag.iteritems())))
+            if (all(rhat < max_rhat for rhat, _ in diag.itervalues())
+                    and diag['LL'][1] >= min_ess):
+                logging.info('Chains converged after %d iterations', t)
+                stop.set()
+    finally:
+        for process in processes:
+            if n_done < n_chains: process.terminate()
+            process.join()
+    return results
@@ -0,0 +1,67 @@
+import os
+import time
+import random
+import logging
+import traceback
+import cPickle
+import numpy as np
+
+def load_checkpoint(path):
+    """Read a checkpoint and restore the RNG states it was taken with
+    -> {'iteration', 'model', ...sampler state}"""
+    with open(path) as f:
+        state = cPickle.load(f)
+    random.setstate(state.pop('random'))
+    np.random.set_state(state.pop('numpy'))
+    logging.info('Resuming from %s at iteration %d', path, state['iteration'])
+    return state
+
+class Checkpoint:
+    """Periodic snapshot of the sampler state; the model is pickled by a forked
+    copy of the process, so the sampler keeps running while it is written,
+    and the file is replaced atomically once complete.
+    The whole model is saved, not only the assignments and hyperparameters: the
+    table seating of every PYP is part of the state of the chain, and reseating
+    the customers from their assignments would draw from the RNG, so the resumed
+    run would no longer match an uninterrupted one. Each checkpoint thus costs a
+    full model dump (in the forked child), which --checkpoint-interval bounds."""
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval # seconds
+        self.last = time.time()
+        self.pid = None
+
+    def __call__(self, iteration, model, **state):
+        if time.time() - self.last >= self.interval:
+            self.save(iteration, model, **state)
+
+    def save(self, iteration, model, **state):
+        self.wait()
+        state.update(iteration=iteration, model=model,
+                random=random.getstate(), numpy=np.random.get_state())
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    cPickle.dump(state, f, protocol=-1)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, self.path)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        logging.info('Writing checkpoint for iteration %d to %s', iteration, self.path)
+        self.pid = pid
+        self.last = time.time()
+
+    def wait(self):
+        """Wait for the checkpoint being written, if any"""
+        if self.pid is None: return
+        _, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        if status != 0:
+            logging.warning('Writing checkpoint to %s failed', self.path)
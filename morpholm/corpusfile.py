@@ -0,0 +1,98 @@
+"""Columnar analyzed corpus format
+
+An analyzed corpus is saved as a directory of flat NumPy arrays: the tokens
+(int32) with sentence offsets, the analyses in CSR form (stem and pattern ids)
+and the string tables of the four vocabularies (or the packed morphemes of a
+PatternVocabulary). It is loaded memory-mapped, so
+concurrent jobs share the pages of the same corpus."""
+import os
+import json
+import shutil
+import cPickle
+import numpy as np
+from modelfile import pack_vocabulary, pack_analyses, VocabularyView, AnalysesView, \
+        ModelReader
+from analyzers.patterns import PatternVocabulary
+
+VERSION = 2
+MANIFEST = 'manifest.json'
+VOCABULARIES = ('vocabulary', 'stem_vocabulary', 'morpheme_vocabulary',
+        'pattern_vocabulary')
+VOCABULARY_ARRAYS = ('kinds', 'text', 'text_offsets', 'ints', 'int_offsets')
+PATTERN_ARRAYS = ('offsets', 'morphemes')
+
+def save_corpus(corpus, path):
+    """Write an analyzed corpus to the directory path in the columnar format"""
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+    def save(name, a):
+        np.save(os.path.join(tmp, name + '.npy'), a)
+    segments = list(corpus)
+    offsets = np.zeros(len(segments)+1, dtype=np.int64)
+    np.cumsum([len(segment) for segment in segments], out=offsets[1:])
+    save('offsets', offsets)
+    save('tokens', np.fromiter((w for segment in segments for w in segment),
+        np.int32, offsets[-1]))
+    for name, a in zip(('keys', 'offsets', 'stems', 'patterns'),
+            pack_analyses(corpus.analyses)):
+        save('analyses.' + name, a)
+    frozen = {}
+    packed = []
+    for vocabulary in VOCABULARIES:
+        v = getattr(corpus, vocabulary)
+        if isinstance(v, PatternVocabulary):
+            names, arrays = PATTERN_ARRAYS, v.packed()
+            packed.append(vocabulary)
+        else:
+            names, arrays = VOCABULARY_ARRAYS, pack_vocabulary(v)
+        for name, a in zip(names, arrays):
+            save('{0}.{1}'.format(vocabulary, name), a)
+        frozen[vocabulary] = bool(getattr(v, 'frozen', False))
+    with open(os.path.join(tmp, MANIFEST), 'w') as f:
+        json.dump({'version': VERSION, 'frozen': frozen, 'packed': packed}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+class MappedCorpus(object):
+    """Memory-mapped analyzed corpus with the interface of an analyzed
+    vpyp.corpus.Corpus: sentences are lists of word ids"""
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest['version'] > VERSION:
+            raise ValueError('Corpus format version {0} is newer than supported ({1})'
+                    .format(manifest['version'], VERSION))
+        reader = ModelReader(path)
+        self.tokens = reader.array('tokens')
+        self.offsets = reader.array('offsets')
+        self.analyses = AnalysesView(*[reader.array('analyses.' + name)
+            for name in ('keys', 'offsets', 'stems', 'patterns')])
+        for vocabulary in VOCABULARIES:
+            packed = vocabulary in manifest.get('packed', ())
+            arrays = [reader.array('{0}.{1}'.format(vocabulary, name))
+                    for name in (PATTERN_ARRAYS if packed else VOCABULARY_ARRAYS)]
+            setattr(self, vocabulary, (PatternVocabulary if packed else VocabularyView)(
+                *arrays, frozen=manifest['frozen'][vocabulary]))
+
+    @property
+    def segments(self):
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)))
+
+def load_corpus(path):
+    """Load an analyzed corpus saved by save_corpus, or a pickled one"""
+    if not os.path.isdir(path):
+        with open(path) as f:
+            return cPickle.load(f)
+    return MappedCorpus(path)
@@ -7,6 +7,7 @@ from itertools import izip
 from collections import Counter
 from vpyp.corpus import Corpus
 from vpyp.prob import DirichletMultinomial, mult_sample
+from ..modelfile import load_model
 
 def read_all_labels(fn):
     with open(fn) as f:
@@ -52,8 +53,7 @@ def main():
     args = parser.parse_args()
     
     logging.info('Loading model')
-    with open(args.model) as f:
-        model = cPickle.load(f)
+    model = load_model(args.model)
 
     logging.info('Computing topic vectors')
 
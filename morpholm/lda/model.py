@@ -1,35 +1,166 @@
 import logging
+import math
+import numpy as np
 from vpyp.prob import DirichletMultinomial
 from vpyp.pyp import PYP
 from vpyp.prior import GammaPrior, PYPPrior, stuple
 from vpyp.lda.model import TopicModel
-from ..models import MorphoProcess
+from ..models import MorphoProcess, AnalysisTable, ProbCache, cumsum_sample, lgamma_sum
+from ..models import seating, seating_delta, seating_log_likelihood, base_log_likelihood, \
+        chain_seating_log_likelihood, chain_prior_log_likelihood
+from ..parallel import resample_chains
+
+class DocumentTopic:
+    """One row of a DocumentTopicMatrix, used like a DirichletMultinomial"""
+    def __init__(self, matrix, d):
+        self.matrix = matrix
+        self.d = d
+
+    count = property(lambda self: self.matrix.counts[self.d])
+    N = property(lambda self: int(self.matrix.lengths[self.d]))
+
+    def increment(self, k):
+        self.matrix.increment(self.d, k)
+
+    def decrement(self, k):
+        self.matrix.decrement(self.d, k)
+
+    def prob(self, k):
+        return self.matrix.prob(self.d, k)
+
+class DocumentTopicMatrix:
+    """Doc-topic counts of all documents in one n_docs x K array, with a
+    symmetric Dirichlet prior shared by all rows"""
+    def __init__(self, n_docs, K, prior):
+        self.prior = prior
+        prior.tie(self)
+        self.K = K
+        self.counts = np.zeros((n_docs, K), dtype=np.int32)
+        self.lengths = np.zeros(n_docs, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, d):
+        return DocumentTopic(self, d)
+
+    def __iter__(self):
+        return (DocumentTopic(self, d) for d in xrange(len(self)))
+
+    def increment(self, d, k):
+        self.counts[d, k] += 1
+        self.lengths[d] += 1
+
+    def decrement(self, d, k):
+        self.counts[d, k] -= 1
+        self.lengths[d] -= 1
+
+    def prob(self, d, k):
+        alpha = self.prior.x
+        return (alpha + self.counts[d, k])/(self.lengths[d] + self.K * alpha)
+
+    def log_likelihood(self, full=False):
+        alpha = self.prior.x
+        n_docs = len(self)
+        ll = (n_docs * (math.lgamma(self.K * alpha) - self.K * math.lgamma(alpha))
+                - lgamma_sum(self.K * alpha, self.lengths)
+                + lgamma_sum(alpha, self.counts))
+        if full:
+            ll += self.prior.log_likelihood()
+        return ll
+
+    def resample_hyperparemeters(self, n_iter, n_workers=1):
+        return self.prior.resample(n_iter)
+
+    def __repr__(self):
+        return 'DocumentTopicMatrix(#docs={0}, K={1})'.format(len(self), self.K)
 
 class MorphoLDA(TopicModel):
-    def __init__(self, n_topics, n_docs, pattern_base, stem_base, analyses):
+    def __init__(self, n_topics, n_docs, pattern_base, stem_base, analyses, compact=False):
         super(MorphoLDA, self).__init__(n_topics)
         self.alpha = GammaPrior(1.0, 1.0, 1.0)
-        self.document_topic = [DirichletMultinomial(n_topics, self.alpha) for _ in xrange(n_docs)]
+        if compact:
+            self.document_topic = DocumentTopicMatrix(n_docs, n_topics, self.alpha)
+        else:
+            self.document_topic = [DirichletMultinomial(n_topics, self.alpha)
+                    for _ in xrange(n_docs)]
         self.stem_base = stem_base
         self.pattern_model = PYP(pattern_base, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_p
+        analyses = AnalysisTable(analyses) # shared by all topics
         def make_topic_word():
             stem_model = PYP(stem_base, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_s
             mp = MorphoProcess(stem_model, self.pattern_model, analyses)
             return PYP(mp, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.1, 1.0)) # G_w
         self.topic_word = [make_topic_word() for _ in xrange(n_topics)]
+        self.reset_log_likelihood() # running log-likelihood terms
+
+    def topic_probs(self, d, w):
+        doc_topic = self.document_topic[d]
+        return np.array([doc_topic.prob(k) * topic.prob(w)
+            for k, topic in enumerate(self.topic_word)])
+
+    def increment(self, d, w):
+        k = cumsum_sample(self.topic_probs(d, w))
+        self.assign(d, w, k)
+        return k
+
+    def assign(self, d, w, k):
+        doc_topic = self.document_topic[d]
+        self.doc_topic_ll += math.log(doc_topic.prob(k))
+        doc_topic.increment(k)
+        topic = self.topic_word[k]
+        state = seating(topic, w)
+        topic.increment(w)
+        self.seating_ll += seating_delta(state, w) + topic.base.take_ll_delta()
+
+    def decrement(self, d, w, k):
+        doc_topic = self.document_topic[d]
+        doc_topic.decrement(k)
+        self.doc_topic_ll -= math.log(doc_topic.prob(k))
+        topic = self.topic_word[k]
+        state = seating(topic, w)
+        topic.decrement(w)
+        self.seating_ll += seating_delta(state, w) + topic.base.take_ll_delta()
+
+    def resample_analyses(self):
+        """Type-based blocked sampling of the analyses in all topics (approximate,
+        see MorphoProcess.resample_type)"""
+        accepted = proposed = 0
+        for topic in self.topic_word:
+            a, p = topic.base.resample_analyses()
+            accepted += a
+            proposed += p
+            self.seating_ll += topic.base.take_ll_delta()
+        return accepted, proposed
+
+    def reset_log_likelihood(self):
+        """Recompute the running terms from scratch (after the hyperparameters change)"""
+        if isinstance(self.document_topic, DocumentTopicMatrix):
+            self.doc_topic_ll = self.document_topic.log_likelihood()
+        else:
+            self.doc_topic_ll = sum(d.log_likelihood() for d in self.document_topic)
+        self.seating_ll = (sum(chain_seating_log_likelihood(topic) for topic in self.topic_word)
+                + seating_log_likelihood(self.pattern_model) # G_p
+                + seating_log_likelihood(self.stem_base)) # G_s^0 if it is a PYP
+        for topic in self.topic_word:
+            topic.base.track_ll_delta()
+        self.prior_ll = sum(chain_prior_log_likelihood(topic) for topic in self.topic_word)
 
     def log_likelihood(self):
-        return (sum(d.log_likelihood() for d in self.document_topic)
+        """Running log-likelihood: the doc-topic and PYP seating terms are updated in
+        closed form by every increment and decrement, the topic hyperparameter terms
+        when they are resampled; only the shared bases and priors are rescored"""
+        return (self.doc_topic_ll + self.seating_ll + self.prior_ll
                 + self.alpha.log_likelihood()
-                + sum(topic.log_likelihood() # G_w
-                    + topic.prior.log_likelihood() # d_w, T_w
-                    + topic.base.stem_model.log_likelihood() # G_s
-                    + topic.base.stem_model.prior.log_likelihood() # d_s, T_s
-                    for topic in self.topic_word)
-                + self.pattern_model.log_likelihood(full=True) # G_p + ...
-                + self.stem_base.log_likelihood(full=True)) # G_s^0 + ...
-
-    def resample_hyperparemeters(self, n_iter):
+                + base_log_likelihood(self.pattern_model) # d_p, T_p, G_p^0
+                + base_log_likelihood(self.stem_base)) # G_s^0
+
+    def full_log_likelihood(self):
+        """Recompute the log-likelihood from scratch"""
+        self.reset_log_likelihood()
+        return self.log_likelihood()
+
+    def resample_hyperparemeters(self, n_iter, n_workers=1):
         ar = stuple((0, 0))
         logging.info('Resampling doc-topic hyperparameters')
         ar += self.alpha.resample(n_iter)
@@ -38,12 +169,17 @@ class MorphoLDA(TopicModel):
         ar += self.pattern_model.base.resample_hyperparemeters(n_iter) # G_p^0
         ar += self.stem_base.resample_hyperparemeters(n_iter) # G_s^0
         logging.info('Resampling all topic-word PYP hyperparameters')
-        for topic in self.topic_word:
-            ar += topic.resample_hyperparemeters(n_iter) # G_w
-            ar += topic.base.stem_model.resample_hyperparemeters(n_iter) # G_s
+        ar += resample_chains(self.topic_word, n_iter, n_workers) # G_w, G_s
+        ProbCache.invalidate()
+        self.reset_log_likelihood()
         return ar
 
     def __repr__(self):
         return ('MorphoLDA(#topics={self.n_topics} '
                 '| alpha={self.alpha}, beta=PYP(base=MP(stem ~ PYP(base={self.stem_base}); '
                 'pattern ~ {self.pattern_model})))').format(self=self)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'prior_ll' not in state: # pickled without running log-likelihood
+            self.reset_log_likelihood()
@@ -1,7 +1,9 @@
 import argparse
 import logging
-import cPickle
-import heapq
+import math
+import numpy as np
+from ..models import batch_prob, batch_log_prob
+from ..modelfile import load_model
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -10,25 +12,24 @@ def main():
     parser.add_argument('model', help='trained model')
     args = parser.parse_args()
 
-    with open(args.model) as m:
-        model = cPickle.load(m)
+    model = load_model(args.model)
 
     pm = model.pattern_model
     def dec(p):
         pattern = model.pattern_vocabulary[p]
         return '+'.join(model.morpheme_vocabulary[m] for m in pattern)
-    patt_prob = ((pm.prob(p), p) for p in xrange(len(model.pattern_vocabulary)))
-    for prob, p in heapq.nlargest(100, patt_prob):
-        print(u'{0} {1}'.format(dec(p), prob).encode('utf8'))
+    patt_lp = batch_log_prob(pm, np.arange(len(model.pattern_vocabulary)))
+    for p in np.argsort(-patt_lp)[:100].tolist():
+        print(u'{0} {1}'.format(dec(p), math.exp(patt_lp[p])).encode('utf8'))
     print('---------')
 
     
     for i, topic in enumerate(model.topic_word):
         print('Topic {0}'.format(i))
         stem_topic = topic.base.stem_model
-        word_prob = ((stem_topic.prob(w), w) for w in xrange(len(model.stem_vocabulary)))
-        for prob, w in heapq.nlargest(10, word_prob):
-            print(u'{0} {1}'.format(model.stem_vocabulary[w], prob).encode('utf8'))
+        word_prob = batch_prob(stem_topic, np.arange(len(model.stem_vocabulary)))
+        for w in np.argsort(-word_prob)[:10].tolist():
+            print(u'{0} {1}'.format(model.stem_vocabulary[w], word_prob[w]).encode('utf8'))
         print('---------')
 
 if __name__ == '__main__':
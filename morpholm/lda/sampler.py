@@ -0,0 +1,89 @@
+import logging
+import math
+import random
+import numpy as np
+from ..models import prune_analyses
+from ..parallel import make_shards, fork_map
+from sparse import SparseTopicSampler
+
+mh_iter = 100
+
+def sample_document(model, d, doc, topics, resample):
+    for i, w in enumerate(doc):
+        if resample: model.decrement(d, w, int(topics[i]))
+        topics[i] = model.increment(d, w)
+
+def _sample_shard(state, shard):
+    model, documents, offsets, topics = state
+    start, end = shard
+    base = offsets[start]
+    new_topics = topics[base:offsets[end]].copy()
+    for d in xrange(start, end):
+        sample_document(model, d, documents[d],
+                new_topics[offsets[d]-base:offsets[d+1]-base], True)
+    return new_topics
+
+def parallel_sweep(model, documents, offsets, topics, n_workers):
+    """AD-LDA sweep: each worker samples a shard of documents against a snapshot
+    of the model, then the topic changes are replayed on the shared counts"""
+    shards = make_shards(offsets, n_workers)
+    results = fork_map(_sample_shard, (model, documents, offsets, topics), shards,
+            random.randrange(2**31))
+    n_changed = 0
+    for (start, end), new_topics in zip(shards, results):
+        base = offsets[start]
+        for d in xrange(start, end):
+            old = topics[offsets[d]:offsets[d+1]]
+            new = new_topics[offsets[d]-base:offsets[d+1]-base]
+            for i in np.flatnonzero(old != new):
+                w = documents[d][i]
+                model.decrement(d, w, int(old[i]))
+                model.assign(d, w, int(new[i]))
+            n_changed += np.count_nonzero(old != new)
+            old[:] = new
+    logging.info('Merged %d topic changes from %d shards', n_changed, len(shards))
+
+def log_progress(model, n_tokens, check):
+    ll = model.log_likelihood()
+    ppl = math.exp(-ll / n_tokens)
+    logging.info('LL=%.0f ppl=%.3f', ll, ppl)
+    if check:
+        full_ll = model.full_log_likelihood()
+        logging.info('Full LL=%.0f (running LL error: %.3g)', full_ll, ll - full_ll)
+
+def trace_values(model):
+    """Quantities compared across chains by the convergence diagnostics"""
+    return {'LL': model.log_likelihood(), 'alpha': model.alpha.x,
+            'pattern_d': model.pattern_model.d, 'pattern_theta': model.pattern_model.theta}
+
+def run_sampler(model, corpus, n_iter, cb=None, n_workers=1, sparse=False,
+        prune=0, burn_in=0, ll_interval=10, ll_check=False):
+    documents = list(corpus)
+    offsets = np.zeros(len(documents)+1, dtype=np.int64)
+    np.cumsum([len(doc) for doc in documents], out=offsets[1:])
+    n_tokens = int(offsets[-1])
+    topics = np.zeros(n_tokens, dtype=np.int32)
+    sampler = SparseTopicSampler(model) if sparse else model
+    for it in xrange(n_iter):
+        logging.info('Iteration %d/%d', it+1, n_iter)
+        if sparse: sampler.refresh()
+        if it == 0 or n_workers == 1:
+            for d, doc in enumerate(documents):
+                sample_document(sampler, d, doc, topics[offsets[d]:offsets[d+1]], it > 0)
+        else:
+            parallel_sweep(sampler, documents, offsets, topics, n_workers)
+        if prune and it == burn_in - 1:
+            before, after = prune_analyses([topic.base for topic in model.topic_word], prune)
+            logging.info('Pruned analyses with posterior < %g: %.2f -> %.2f per word',
+                    prune, before, after)
+        if ll_interval and it % ll_interval == ll_interval - 1:
+            log_progress(model, n_tokens, ll_check)
+            logging.info('Model: %s', model)
+        if it % 30 == 29:
+            logging.info('Resampling hyperparameters...')
+            acceptance, rejection = model.resample_hyperparemeters(mh_iter, n_workers)
+            arate = acceptance / float(acceptance + rejection)
+            logging.info('Metropolis-Hastings acceptance rate: %.4f', arate)
+            logging.info('Model: %s', model)
+        if cb and cb(it): break
+    return topics
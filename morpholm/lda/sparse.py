@@ -0,0 +1,127 @@
+import random
+import numpy as np
+from ..models import batch_prob, cumsum_sample
+
+def new_table_mass(pyp):
+    """Weight of the base distribution in the predictive distribution of pyp"""
+    return (pyp.theta + pyp.d * pyp.ntables) / (pyp.theta + pyp.total_customers)
+
+class SparseTopicSampler:
+    """SparseLDA-style topic sampler for MorphoLDA
+
+    When neither w nor any of its stems is seated in topic k,
+        p_k(w) = Z_k * Q(w)
+    with Z_k = new_table_mass(G_w^k) * new_table_mass(G_s^k)
+    and Q(w) = sum_a G_s^0(stem_a) G_p(pattern_a), which is shared by all topics.
+    The mass of (alpha + n_dk) p_k(w) is then split into:
+        - a topic-word bucket: exact evaluation for the topics seating w or its stems
+        - a document bucket: n_dk Z_k Q(w) for the other topics used by document d
+        - a smoothing bucket: alpha Z_k Q(w) for the other topics
+    The smoothing mass sum_k Z_k and the document mass sum_k n_dk Z_k of the
+    current document are kept as running sums, updated in O(1) per count change,
+    so the cost per token grows with the number of topics seating w or its stems
+    and of topics used by d, not with K (except for draws from the smoothing bucket).
+    The sampler must be created before any token is assigned to the model."""
+    def __init__(self, model):
+        self.model = model
+        self.table = model.topic_word[0].base.table
+        self.word_stems = {}
+        self.stem_topics = {} # stem -> {topic: number of tokens with this stem}
+        self.doc_counts = {} # document -> {topic: n_dk}
+        self.refresh()
+
+    def refresh(self):
+        """Recompute Z for all topics (after hyperparameter resampling) and the
+        running sums"""
+        self.Z = np.array([self.topic_mass(k) for k in xrange(self.model.n_topics)])
+        self.s = float(self.Z.sum())
+        self.d = None
+        self.r = 0.0
+
+    def enter(self, d):
+        """Make d the current document, whose document mass is kept up to date"""
+        self.d = d
+        counts = self.doc_counts.get(d, {})
+        self.r = sum(n * self.Z[k] for k, n in counts.iteritems())
+
+    def topic_mass(self, k):
+        topic = self.model.topic_word[k]
+        return new_table_mass(topic) * new_table_mass(topic.base.stem_model)
+
+    def stems(self, w):
+        stems = self.word_stems.get(w)
+        if stems is None:
+            lo, hi = self.table.span(w)
+            stems = self.word_stems[w] = np.unique(self.table.stems[lo:hi]).tolist()
+        return stems
+
+    def exact_topics(self, w):
+        topics = set()
+        for stem in self.stems(w):
+            topics.update(self.stem_topics.get(stem, ()))
+        return sorted(topics)
+
+    def base_prob(self, w):
+        lo, hi = self.table.span(w)
+        return float((batch_prob(self.model.stem_base, self.table.stems[lo:hi])
+            * batch_prob(self.model.pattern_model, self.table.patterns[lo:hi])).sum())
+
+    def increment(self, d, w):
+        if d != self.d:
+            self.enter(d)
+        alpha = self.model.alpha.x
+        counts = self.doc_counts.get(d, {})
+        exact = self.exact_topics(w)
+        exact_mass = [(alpha + counts.get(k, 0)) * self.model.topic_word[k].prob(w)
+                for k in exact]
+        Q = self.base_prob(w)
+        # Remove the exactly evaluated topics from the running sums
+        s = self.s - sum(self.Z[k] for k in exact)
+        r = self.r - sum(counts.get(k, 0) * self.Z[k] for k in exact)
+        q, doc_mass, smoothing_mass = sum(exact_mass), max(r, 0) * Q, alpha * max(s, 0) * Q
+        u = random.random() * (q + doc_mass + smoothing_mass)
+        if u < q:
+            k = exact[cumsum_sample(exact_mass)]
+        else:
+            excluded = set(exact)
+            doc_topics = [k for k in sorted(counts) if k not in excluded]
+            if u < q + doc_mass and doc_topics:
+                k = doc_topics[cumsum_sample([counts[k] * self.Z[k] for k in doc_topics])]
+            else:
+                Z = self.Z.copy()
+                Z[exact] = 0
+                k = cumsum_sample(Z)
+        self.assign(d, w, k)
+        return k
+
+    def update(self, d, k, dn):
+        """Apply a change by dn of n_dk, and the resulting change of Z_k, to the
+        running sums"""
+        old_z = self.Z[k]
+        new_z = self.Z[k] = self.topic_mass(k)
+        self.s += new_z - old_z
+        counts = self.doc_counts.setdefault(d, {})
+        old_n = counts.get(k, 0)
+        if old_n + dn:
+            counts[k] = old_n + dn
+        else:
+            del counts[k]
+        if self.d is not None:
+            n = self.doc_counts.get(self.d, {}).get(k, 0)
+            self.r += n * new_z - (old_n if d == self.d else n) * old_z
+
+    def assign(self, d, w, k):
+        self.model.assign(d, w, k)
+        for stem in self.stems(w):
+            topics = self.stem_topics.setdefault(stem, {})
+            topics[k] = topics.get(k, 0) + 1
+        self.update(d, k, 1)
+
+    def decrement(self, d, w, k):
+        self.model.decrement(d, w, k)
+        for stem in self.stems(w):
+            topics = self.stem_topics[stem]
+            topics[k] -= 1
+            if topics[k] == 0:
+                del topics[k]
+        self.update(d, k, -1)
@@ -1,3 +1,4 @@
+import os
 import argparse
 import logging
 import cPickle
@@ -5,9 +6,11 @@ from vpyp.prob import Uniform
 from vpyp.charlm import CharLM
 from vpyp.prior import PYPPrior, GammaPrior
 from vpyp.pyp import PYP
-from vpyp.lda.train import run_sampler
 from ..models import BigramPattern
 from model import MorphoLDA
+from ..chains import run_chains
+from ..corpusfile import load_corpus
+from sampler import run_sampler, trace_values
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -20,12 +23,31 @@ def main():
     parser.add_argument('--pyp', help='G_w^0 is PYP(CharLM)', action='store_true')
     parser.add_argument('--model', help='model type', type=int, default=0)
     parser.add_argument('--output', help='model output prefix')
+    parser.add_argument('--compact', help='store doc-topic counts in a single array',
+            action='store_true')
+    parser.add_argument('--sparse', help='bucketed (SparseLDA) topic sampler',
+            action='store_true')
+    parser.add_argument('--ll-interval', help='log the log-likelihood every N iterations'
+            ' (0: never)', type=int, default=10)
+    parser.add_argument('--ll-check', help='check the running log-likelihood against'
+            ' a full recomputation', action='store_true')
+    parser.add_argument('--prune', help='after burn-in, drop analyses with a posterior'
+            ' below this threshold', type=float, default=0)
+    parser.add_argument('--burn-in', help='number of iterations before pruning', type=int,
+            default=100)
+    parser.add_argument('--jobs', help='number of parallel sampling processes (AD-LDA)',
+            type=int, default=1)
+    parser.add_argument('--chains', help='number of independent chains run in parallel'
+            ' (the best one is kept)', type=int, default=1)
+    parser.add_argument('--rhat', help='stop the chains when the R-hat of all traced'
+            ' quantities is below this value', type=float, default=1.1)
+    parser.add_argument('--min-ess', help='but not before the effective sample size of'
+            ' the log-likelihood reaches this value', type=float, default=100)
 
     args = parser.parse_args()
 
     logging.info('Reading training corpus')
-    with open(args.train) as train:
-        training_corpus = cPickle.load(train)
+    training_corpus = load_corpus(args.train)
 
     if args.charlm:
         logging.info('Preloading stem character language model')
@@ -48,21 +70,51 @@ def main():
 
 
     model = MorphoLDA(args.topics, len(training_corpus), 
-            pattern_base, stem_base, training_corpus.analyses)
+            pattern_base, stem_base, training_corpus.analyses, compact=args.compact)
 
-    def save_callback(it):
+    def save(path):
+        logging.info('Saving model...')
+        with open(path, 'w') as f:
+            model.vocabulary = training_corpus.vocabulary
+            model.stem_vocabulary = training_corpus.stem_vocabulary
+            model.morpheme_vocabulary = training_corpus.morpheme_vocabulary
+            model.pattern_vocabulary = training_corpus.pattern_vocabulary
+            model.analyses = training_corpus.analyses
+            cPickle.dump(model, f, protocol=-1)
+
+    def save_callback(it, prefix=args.output):
         if args.output and it % 100 == 99:
-            logging.info('Saving model...')
-            with open('{0}.{1}.pickle'.format(args.output, it+1), 'w') as f:
-                model.vocabulary = training_corpus.vocabulary
-                model.stem_vocabulary = training_corpus.stem_vocabulary
-                model.morpheme_vocabulary = training_corpus.morpheme_vocabulary
-                model.pattern_vocabulary = training_corpus.pattern_vocabulary
-                model.analyses = training_corpus.analyses
-                cPickle.dump(model, f, protocol=-1)
+            save('{0}.{1}.pickle'.format(prefix, it+1))
+
+    def train_chain(chain, report):
+        prefix = '{0}.chain{1}'.format(args.output, chain)
+        def cb(it):
+            save_callback(it, prefix)
+            return report(it, trace_values(model))
+        run_sampler(model, training_corpus, args.iter, cb=cb,
+                n_workers=args.jobs, sparse=args.sparse,
+                prune=args.prune, burn_in=args.burn_in,
+                ll_interval=args.ll_interval, ll_check=args.ll_check)
+        if args.output:
+            save('{0}.pickle'.format(prefix))
+        return model.log_likelihood()
+
+    if args.chains > 1:
+        logging.info('Training %d chains with %d topics (%d jobs each)',
+                args.chains, args.topics, args.jobs)
+        lls = run_chains(train_chain, args.chains, args.rhat, args.min_ess)
+        best = max(xrange(args.chains), key=lambda chain: lls[chain])
+        logging.info('Keeping chain %d (LL=%.0f)', best, lls[best])
+        if args.output:
+            os.rename('{0}.chain{1}.pickle'.format(args.output, best),
+                    '{0}.pickle'.format(args.output))
+        return
 
-    logging.info('Training model with %d topics', args.topics)
-    run_sampler(model, training_corpus, args.iter, cb=save_callback)
+    logging.info('Training model with %d topics (%d jobs)', args.topics, args.jobs)
+    run_sampler(model, training_corpus, args.iter, cb=save_callback,
+            n_workers=args.jobs, sparse=args.sparse,
+            prune=args.prune, burn_in=args.burn_in,
+            ll_interval=args.ll_interval, ll_check=args.ll_check)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,482 @@
+"""Memory-mapped model format
+
+A model is saved as a directory holding a small pickle of its object graph
+(MANIFEST, SKELETON) and flat NumPy arrays for the bulk of its data:
+- large arrays (pattern model counts, analysis tables, assignments...),
+- dicts of int -> int sequences (PYP tables), pooled in shared arrays,
+- analyses dicts, as CSR arrays of stems and patterns,
+- vocabularies, as UTF-8 string tables and packed patterns,
+- pattern vocabularies, as their packed morpheme arrays.
+Loading maps the arrays read-only and replaces the dicts and vocabularies with
+lazy views, so only the parts of the model that are queried are read."""
+import os
+import json
+import shutil
+import logging
+import argparse
+import cPickle
+from collections import defaultdict
+from itertools import chain, izip
+import numpy as np
+from vpyp.corpus import Vocabulary, OOV
+from analyzers.analyzer import Analysis
+from analyzers.patterns import PatternVocabulary
+
+VERSION = 2
+MANIFEST = 'manifest.json'
+SKELETON = 'model.pickle'
+MIN_ARRAY_BYTES = 4096 # smaller arrays stay in the skeleton
+
+def _int_sequence(value):
+    if isinstance(value, np.ndarray):
+        return value.ndim == 1 and value.dtype.kind in 'iu'
+    return isinstance(value, (list, tuple)) and all(type(x) in (int, long) for x in value)
+
+def _analyses(value):
+    return (isinstance(value, (list, tuple))
+            and all(isinstance(analysis, Analysis) for analysis in value))
+
+def _dict_kind(d):
+    """Storage of a dict of int keys in the pools: 'intdict', 'analyses' or None"""
+    if type(d) not in (dict, defaultdict) or not d: return None
+    k, v = next(d.iteritems())
+    if type(k) not in (int, long): return None
+    for check, kind in ((_int_sequence, 'intdict'), (_analyses, 'analyses')):
+        if check(v) and all(type(k) in (int, long) and check(v) for k, v in d.iteritems()):
+            return kind
+    return None
+
+def _value_kind(values):
+    kinds = set(type(v).__name__ if not isinstance(v, np.ndarray) else v.dtype.name
+            for v in values)
+    return kinds.pop() if len(kinds) == 1 else None
+
+class Pool:
+    """Segments of integers appended to shared arrays: segment i is
+    columns[c][offsets[i]:offsets[i+1]] for each column c"""
+    def __init__(self, n_columns):
+        self.keys = []
+        self.lengths = []
+        self.columns = [[] for _ in xrange(n_columns)]
+
+    def add(self, keys, segments):
+        start = len(self.keys)
+        for k, segment in izip(keys, segments):
+            self.keys.append(k)
+            self.lengths.append(len(segment[0]))
+            for column, values in izip(self.columns, segment):
+                column.append(np.asarray(values, dtype=np.int64))
+        return start, len(self.keys)
+
+    def arrays(self):
+        offsets = np.zeros(len(self.lengths)+1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+        columns = [narrow(np.concatenate(column) if column else np.zeros(0, dtype=np.int64))
+                for column in self.columns]
+        return [np.array(self.keys, dtype=np.int64), offsets] + columns
+
+def narrow(a):
+    if not len(a) or (a.min() >= np.iinfo(np.int32).min and a.max() <= np.iinfo(np.int32).max):
+        return a.astype(np.int32)
+    return a
+
+def pack_vocabulary(vocabulary):
+    """-> (kinds, text, text_offsets, ints, int_offsets) arrays of the entries of
+    a vocabulary of strings and patterns (kinds[i] = 1), or None if it has others"""
+    entries = list(vocabulary)
+    if not all(isinstance(w, basestring) or (isinstance(w, tuple) and _int_sequence(w))
+            for w in entries):
+        return None
+    kinds = np.array([isinstance(w, tuple) for w in entries], dtype=np.int8)
+    text = [w.encode('utf8') if isinstance(w, unicode) else w if isinstance(w, str) else ''
+            for w in entries]
+    text_offsets = np.zeros(len(entries)+1, dtype=np.int64)
+    np.cumsum([len(t) for t in text], out=text_offsets[1:])
+    ints = [w if isinstance(w, tuple) else () for w in entries]
+    int_offsets = np.zeros(len(entries)+1, dtype=np.int64)
+    np.cumsum([len(t) for t in ints], out=int_offsets[1:])
+    return (kinds, np.array(bytearray(''.join(text)), dtype=np.uint8), text_offsets,
+            np.fromiter((m for t in ints for m in t), np.int32, int_offsets[-1]), int_offsets)
+
+def pack_analyses(analyses):
+    """-> (keys, offsets, stems, patterns) CSR arrays of an analyses dict"""
+    keys = sorted(analyses)
+    pool = Pool(2)
+    pool.add(keys, (([a.stem for a in analyses[k]], [a.pattern for a in analyses[k]])
+        for k in keys))
+    return pool.arrays()
+
+class ModelWriter:
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+        self.ids = {} # id(obj) -> persistent id
+        self.objects = [] # keep the objects seen alive so that ids are not reused
+        self.intdicts = Pool(1) # values
+        self.analyses = Pool(2) # stems, patterns
+
+    def persistent_id(self, obj):
+        if isinstance(obj, (int, long, float, basestring, tuple)) or obj is None:
+            return None
+        key = id(obj)
+        if key in self.ids:
+            return self.ids[key]
+        pid = None
+        if isinstance(obj, np.ndarray):
+            if obj.dtype != object and obj.nbytes >= MIN_ARRAY_BYTES:
+                pid = ('array', self.add_array(obj))
+        elif isinstance(obj, PatternVocabulary):
+            pid = ('patterns', tuple(map(self.add_array, obj.packed())), obj.frozen)
+        elif isinstance(obj, (Vocabulary, VocabularyView)):
+            pid = self.add_vocabulary(obj)
+        elif isinstance(obj, dict):
+            pid = self.add_dict(obj)
+        if pid is not None:
+            self.ids[key] = pid
+            self.objects.append(obj)
+        return pid
+
+    def add_array(self, a):
+        name = 'a{0}'.format(len(self.arrays))
+        self.arrays[name] = a
+        return name
+
+    def add_dict(self, d):
+        kind = _dict_kind(d)
+        if kind is None: return None
+        keys = sorted(d)
+        if kind == 'analyses':
+            start, end = self.analyses.add(keys, (([a.stem for a in d[k]],
+                [a.pattern for a in d[k]]) for k in keys))
+            return ('analyses', start, end)
+        value_kind = _value_kind(d.itervalues())
+        if value_kind is None: return None
+        start, end = self.intdicts.add(keys, ((d[k],) for k in keys))
+        return ('intdict', start, end, value_kind, getattr(d, 'default_factory', None))
+
+    def add_vocabulary(self, vocabulary):
+        arrays = pack_vocabulary(vocabulary)
+        if arrays is None: return None
+        names = tuple(self.add_array(a) for a in arrays)
+        return ('vocabulary', names, bool(getattr(vocabulary, 'frozen', False)))
+
+    def save(self, model):
+        with open(os.path.join(self.path, SKELETON), 'wb') as f:
+            pickler = cPickle.Pickler(f, -1)
+            pickler.persistent_id = self.persistent_id
+            pickler.dump(model)
+        for pool, prefix in ((self.intdicts, 'intdict'), (self.analyses, 'analyses')):
+            for name, a in izip(('keys', 'offsets', 'values0', 'values1'), pool.arrays()):
+                self.arrays['{0}.{1}'.format(prefix, name)] = a
+        for name, a in self.arrays.iteritems():
+            np.save(os.path.join(self.path, name + '.npy'), a)
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump({'version': VERSION, 'arrays': sorted(self.arrays)}, f)
+
+def save_model(model, path):
+    """Write model to the directory path in the memory-mapped format"""
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+    ModelWriter(tmp).save(model)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+class IntDictView(object):
+    """Read-only dict of int -> int sequence over sorted keys and CSR values"""
+    def __init__(self, keys, offsets, values, value_kind, default_factory):
+        self._keys = keys
+        self._offsets = offsets
+        self._values = values
+        self.value_kind = value_kind
+        self.default_factory = default_factory
+
+    def _find(self, k):
+        i = int(np.searchsorted(self._keys, k))
+        return i if i < len(self._keys) and self._keys[i] == k else -1
+
+    def _value(self, i):
+        values = self._values[self._offsets[i]:self._offsets[i+1]]
+        if self.value_kind == 'list':
+            return values.tolist()
+        if self.value_kind == 'tuple':
+            return tuple(values.tolist())
+        return values.astype(self.value_kind)
+
+    def __getitem__(self, k):
+        i = self._find(k)
+        if i >= 0:
+            return self._value(i)
+        if self.default_factory is not None: # missing keys are not inserted
+            return self.default_factory()
+        raise KeyError(k)
+
+    def get(self, k, default=None):
+        i = self._find(k)
+        return self._value(i) if i >= 0 else default
+
+    def __contains__(self, k):
+        return self._find(k) >= 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys.tolist())
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return (self._value(i) for i in xrange(len(self)))
+
+    def iteritems(self):
+        return izip(self, self.itervalues())
+
+    def keys(self):
+        return self._keys.tolist()
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __setitem__(self, k, value):
+        raise TypeError('memory-mapped model is read-only')
+
+    def __reduce__(self):
+        if self.default_factory is not None:
+            return (defaultdict, (self.default_factory,), None, None, self.iteritems())
+        return (dict, (), None, None, self.iteritems())
+
+class AnalysesView(object):
+    """Dict of word -> analyses over sorted keys and CSR stems and patterns;
+    analyses of new words are kept in memory"""
+    def __init__(self, keys, offsets, stems, patterns):
+        self._keys = keys
+        self._offsets = offsets
+        self._stems = stems
+        self._patterns = patterns
+        self.added = {}
+
+    def _find(self, k):
+        i = int(np.searchsorted(self._keys, k))
+        return i if i < len(self._keys) and self._keys[i] == k else -1
+
+    def __getitem__(self, k):
+        if k in self.added:
+            return self.added[k]
+        i = self._find(k)
+        if i < 0: raise KeyError(k)
+        lo, hi = self._offsets[i], self._offsets[i+1]
+        return tuple(Analysis(s, p) for s, p in izip(self._stems[lo:hi].tolist(),
+            self._patterns[lo:hi].tolist()))
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    def __setitem__(self, k, analyses):
+        self.added[k] = analyses
+
+    def update(self, other):
+        for k, analyses in other.iteritems():
+            self[k] = analyses
+
+    def __contains__(self, k):
+        return k in self.added or self._find(k) >= 0
+
+    def __len__(self):
+        return len(self._keys) + sum(1 for k in self.added if self._find(k) < 0)
+
+    def __iter__(self):
+        return chain(self._keys.tolist(), (k for k in self.added if self._find(k) < 0))
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return (self[k] for k in self)
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def csr(self):
+        """-> (offsets, stems, patterns) of words 0..len(self)-1 if they are exactly
+        the mapped keys, else None"""
+        n = len(self._keys)
+        if (n and self._keys[-1] != n - 1) or any(k < n for k in self.added):
+            return None
+        lo, hi = self._offsets[0], self._offsets[-1]
+        return np.asarray(self._offsets - lo), self._stems[lo:hi], self._patterns[lo:hi]
+
+    def __reduce__(self):
+        return (dict, (), None, None, self.iteritems())
+
+class VocabularyView(object):
+    """Vocabulary over a string table (and packed patterns, for pattern
+    vocabularies); the reverse index is only built when a key is looked up"""
+    def __init__(self, kinds, text, text_offsets, ints, int_offsets, frozen):
+        self.kinds = kinds
+        self.text = text
+        self.text_offsets = text_offsets
+        self.ints = ints
+        self.int_offsets = int_offsets
+        self.frozen = frozen
+        self.added = []
+        self._id2word = None
+        self._word2id = None
+
+    def entry(self, i):
+        if self.kinds[i]:
+            return tuple(self.ints[self.int_offsets[i]:self.int_offsets[i+1]].tolist())
+        return self.text[self.text_offsets[i]:self.text_offsets[i+1]].tostring().decode('utf8')
+
+    @property
+    def id2word(self):
+        if self._id2word is None:
+            self._id2word = list(self)
+        return self._id2word
+
+    @property
+    def word2id(self):
+        if self._word2id is None:
+            self._word2id = dict((w, i) for i, w in enumerate(self))
+        return self._word2id
+
+    def __getitem__(self, word):
+        if isinstance(word, (int, long, np.integer)):
+            if self._id2word is not None:
+                return self._id2word[word]
+            n = len(self.kinds)
+            return self.entry(word) if word < n else self.added[word - n]
+        i = self.word2id.get(word)
+        if i is None:
+            if self.frozen: raise OOV(word)
+            i = self.word2id[word] = len(self)
+            if self._id2word is not None:
+                self._id2word.append(word)
+            else:
+                self.added.append(word)
+        return i
+
+    def update(self, other):
+        for word in other:
+            self[word]
+
+    def __contains__(self, word):
+        return word in self.word2id
+
+    def __len__(self):
+        if self._id2word is not None:
+            return len(self._id2word)
+        return len(self.kinds) + len(self.added)
+
+    def __iter__(self):
+        if self._id2word is not None:
+            return iter(self._id2word)
+        return chain((self.entry(i) for i in xrange(len(self.kinds))), self.added)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('kinds', 'text', 'text_offsets', 'ints', 'int_offsets'):
+            state[name] = np.array(state[name])
+        state['_word2id'] = None
+        return state
+
+class ModelReader:
+    def __init__(self, path):
+        self.path = path
+        self.objects = {}
+        self.arrays = {} # each file is mapped once, views are slices of it
+
+    def array(self, name):
+        if name not in self.arrays:
+            path = os.path.join(self.path, name + '.npy')
+            try:
+                self.arrays[name] = np.load(path, mmap_mode='r')
+            except ValueError: # empty arrays cannot be mapped
+                self.arrays[name] = np.load(path)
+        return self.arrays[name]
+
+    def persistent_load(self, pid):
+        if pid in self.objects:
+            return self.objects[pid]
+        kind = pid[0]
+        if kind == 'array':
+            obj = self.array(pid[1])
+        elif kind == 'vocabulary':
+            _, names, frozen = pid
+            kinds, text, text_offsets, ints, int_offsets = map(self.array, names)
+            obj = VocabularyView(kinds, text, text_offsets, ints, int_offsets, frozen)
+        elif kind == 'patterns':
+            _, names, frozen = pid
+            obj = PatternVocabulary(*map(self.array, names), frozen=frozen)
+        elif kind == 'intdict':
+            _, start, end, value_kind, default = pid
+            obj = IntDictView(self.array('intdict.keys')[start:end],
+                    self.array('intdict.offsets')[start:end+1],
+                    self.array('intdict.values0'), value_kind, default)
+        elif kind == 'analyses':
+            _, start, end = pid
+            obj = AnalysesView(self.array('analyses.keys')[start:end],
+                    self.array('analyses.offsets')[start:end+1],
+                    self.array('analyses.values0'), self.array('analyses.values1'))
+        else:
+            raise cPickle.UnpicklingError('Unknown persistent id {0}'.format(pid))
+        self.objects[pid] = obj
+        return obj
+
+    def load(self):
+        with open(os.path.join(self.path, SKELETON), 'rb') as f:
+            unpickler = cPickle.Unpickler(f)
+            unpickler.persistent_load = self.persistent_load
+            return unpickler.load()
+
+def load_model(path):
+    """Load a model saved by save_model, or a pickled model"""
+    if not os.path.isdir(path):
+        with open(path) as f:
+            return cPickle.load(f)
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest['version'] > VERSION:
+        raise ValueError('Model format version {0} is newer than supported ({1})'
+                .format(manifest['version'], VERSION))
+    return ModelReader(path).load()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Convert a pickled model to the'
+            ' memory-mapped format')
+    parser.add_argument('model', help='pickled model')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--check', action='store_true',
+            help='load the written model and compare its log-likelihood')
+    args = parser.parse_args()
+
+    logging.info('Loading model')
+    with open(args.model) as f:
+        model = cPickle.load(f)
+    logging.info('Writing %s', args.output)
+    save_model(model, args.output)
+    if args.check:
+        ll, loaded_ll = model.log_likelihood(), load_model(args.output).log_likelihood()
+        logging.info('LL=%.2f, loaded LL=%.2f', ll, loaded_ll)
+        if abs(ll - loaded_ll) > 1e-6 * abs(ll):
+            raise ValueError('Loaded model differs from {0}'.format(args.model))
+
+if __name__ == '__main__':
+    main()
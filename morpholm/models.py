@@ -1,35 +1,369 @@
-import operator
 import logging
 import random
-from collections import defaultdict
-from itertools import tee, izip
-from vpyp.prob import mult_sample, remove_random,\
-        DirichletMultinomial, GammaPoisson, Uniform, BetaBernouilli
+import math
+from collections import defaultdict, OrderedDict
+from itertools import izip
+import numpy as np
+from vpyp.prob import GammaPoisson, Uniform, BetaBernouilli
 from vpyp.corpus import START, STOP
 
-prod = lambda it: reduce(operator.mul, it, 1)
+def lgamma_sum(a, counts):
+    """sum(lgamma(a + n) for n in counts), grouping equal counts"""
+    values, multiplicity = np.unique(counts, return_counts=True)
+    return sum(m * math.lgamma(a + v) for v, m in izip(values, multiplicity))
+
+def gather_segments(offsets, ids):
+    """-> (positions of all elements of segments ids, start of each segment in positions)"""
+    ids = np.asarray(ids, dtype=np.int64)
+    starts = offsets[ids]
+    lengths = offsets[ids+1] - starts
+    heads = np.zeros(len(ids), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=heads[1:])
+    positions = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - heads, lengths)
+    return positions, heads
+
+def pack_patterns(vocabulary, start=0):
+    """-> (lengths, morphemes) of patterns start..len(vocabulary)-1
+    Reserved non-pattern entries (START, STOP) are packed as empty patterns."""
+    if hasattr(vocabulary, 'packed'): # PatternVocabulary
+        offsets, morphemes = vocabulary.packed()
+        return np.diff(offsets[start:]), morphemes[offsets[start]:]
+    patterns = [vocabulary[p] for p in xrange(start, len(vocabulary))]
+    patterns = [pattern if isinstance(pattern, tuple) else () for pattern in patterns]
+    lengths = np.fromiter((len(pattern) for pattern in patterns), np.int64, len(patterns))
+    morphemes = np.fromiter((m for pattern in patterns for m in pattern), np.int32, lengths.sum())
+    return lengths, morphemes
+
+def safe_log(p):
+    return math.log(p) if p > 0 else float('-inf')
+
+def item_log_prob(model, k):
+    """Log-probability of the item k under model, in log space if it supports it"""
+    if hasattr(model, 'log_prob'):
+        return model.log_prob(k)
+    return safe_log(model.prob(k))
+
+def batch_prob(model, ks):
+    """Probabilities of the items ks under model, in one call if it supports batches"""
+    if hasattr(model, 'prob_many'):
+        return model.prob_many(ks)
+    return np.fromiter((model.prob(int(k)) for k in ks), np.float64, len(ks))
+
+def batch_log_prob(model, ks):
+    """Log-probabilities of the items ks under model, in one call if it supports batches"""
+    if hasattr(model, 'log_prob_many'):
+        return model.log_prob_many(ks)
+    if hasattr(model, 'log_prob'):
+        return np.fromiter((model.log_prob(int(k)) for k in ks), np.float64, len(ks))
+    with np.errstate(divide='ignore'):
+        return np.log(batch_prob(model, ks))
+
+def segment_logsumexp(values, heads, lengths):
+    """log(sum(exp(values))) over the segments starting at heads; -inf if empty"""
+    result = np.empty(len(heads))
+    result.fill(float('-inf'))
+    full = lengths > 0
+    if full.any():
+        heads, lengths = heads[full], lengths[full]
+        top = np.maximum.reduceat(values, heads)
+        top[np.isneginf(top)] = 0
+        with np.errstate(divide='ignore'):
+            result[full] = top + np.log(np.add.reduceat(
+                np.exp(values - np.repeat(top, lengths)), heads))
+    return result
+
+def cumsum_sample(weights):
+    """Draw an index with probability proportional to weights"""
+    cdf = np.cumsum(weights)
+    i = np.searchsorted(cdf, random.random() * cdf[-1], side='right')
+    return min(int(i), len(cdf) - 1)
+
+def log_sample(log_weights):
+    """Draw an index with probability proportional to exp(log_weights)"""
+    top = log_weights.max()
+    if np.isneginf(top):
+        return len(log_weights) - 1
+    return cumsum_sample(np.exp(log_weights - top))
+
+def prune_analyses(mps, threshold):
+    """Drop the analyses of each word whose posterior is below threshold in all the
+    processes mps (which share one AnalysisTable). Analyses assigned to a customer
+    are never dropped, and words without customers are left untouched.
+    -> (analyses per word before, after)"""
+    table = mps[0].table
+    table.refresh()
+    before = table.analyses_per_word()
+    keep = np.zeros(len(table.stems), dtype=bool)
+    seen = np.zeros(table.n_words, dtype=bool)
+    for mp in mps:
+        ks = np.array(sorted(mp.assignments), dtype=np.int64)
+        if not len(ks): continue
+        _, _, posteriors, _ = mp.decode_many(ks)
+        positions, _ = gather_segments(table.offsets, ks)
+        counts = np.concatenate([mp.assignments[k] for k in ks])
+        keep[positions[(posteriors >= threshold) | (counts > 0)]] = True
+        seen[ks] = True
+    unseen = np.flatnonzero(~seen)
+    keep[gather_segments(table.offsets, unseen)[0]] = True
+    for mp in mps:
+        for k, counts in mp.assignments.iteritems():
+            lo, hi = table.offsets[k], table.offsets[k+1]
+            mp.assignments[k] = counts[keep[lo:hi]]
+    table.prune(keep)
+    ProbCache.invalidate()
+    return before, table.analyses_per_word()
+
+def seating(model, k):
+    """Seating of k in a PYP and in the PYPs below it, up to the first base which is
+    not a PYP -> state for seating_delta"""
+    state = []
+    while hasattr(model, 'base'): # PYP
+        state.append((model, list(model.tables.get(k, ())), model.total_customers,
+            model.ntables))
+        model = model.base
+    return state
+
+def seating_delta(state, k):
+    """Change of the seating log-likelihoods (PYP.log_likelihood()) of the PYPs of state
+    after adding or removing one customer k, in closed form: only the tables of k,
+    the number of customers and the number of tables have changed"""
+    delta = 0.0
+    for pyp, tables, n, t in state:
+        dn, dt = pyp.total_customers - n, pyp.ntables - t
+        if not dn: break # the customer did not reach this level
+        d, theta = pyp.d, pyp.theta
+        delta += (sum(math.lgamma(c - d) for c in pyp.tables.get(k, ()))
+                - sum(math.lgamma(c - d) for c in tables)
+                - dt * math.lgamma(1 - d)
+                - dn * math.log(theta + min(n, n + dn)))
+        if dt:
+            delta += dt * math.log(theta + d * min(t, t + dt))
+    return delta
+
+def seating_log_likelihood(model):
+    """Seating terms of the log-likelihood of a PYP and of the PYPs below it"""
+    ll = 0.0
+    while hasattr(model, 'base'): # PYP
+        ll += model.log_likelihood()
+        model = model.base
+    return ll
+
+def base_log_likelihood(model):
+    """Full log-likelihood of a PYP without the seating terms (seating_log_likelihood):
+    the priors of the PYPs and the first base which is not a PYP"""
+    ll = 0.0
+    while hasattr(model, 'base'): # PYP
+        ll += model.prior.log_likelihood()
+        model = model.base
+    return ll + model.log_likelihood(full=True)
+
+def chain_prior_log_likelihood(word_model):
+    """Log-likelihood of the hyperparameters of a PYP(MP) chain and of its own stem PYP"""
+    return (word_model.prior.log_likelihood() # d_w, T_w
+            + word_model.base.stem_model.prior.log_likelihood()) # d_s, T_s
+
+def chain_seating_log_likelihood(word_model):
+    """Seating terms of a PYP(MP) chain and of its own stem PYP, without the shared bases"""
+    return (word_model.log_likelihood() # G_w
+            + word_model.base.stem_model.log_likelihood()) # G_s
+
+def grow_base(base, vocabulary):
+    """Extend a base distribution over the ids of vocabulary (Uniform, CharLM or a PYP
+    over one of them) to the words added to the vocabulary since it was built"""
+    if isinstance(base, Uniform):
+        base.K = len(vocabulary)
+    elif hasattr(base, 'base'): # PYP
+        grow_base(base.base, vocabulary)
+    else: # CharLM scores the strings of its vocabulary
+        base.vocabulary = vocabulary
+
+class ProbCache:
+    """Bounded LRU cache of the analysis log-probabilities of words (keyed by word)
+    and of single analyses (keyed by (stem, pattern)), valid for one generation.
+    Entries are dropped as soon as any count or hyperparameter changes: PYP
+    probabilities depend on shared normalizers and base measures, so an update to
+    one stem or pattern moves the others too. The cache is thus meant for frozen
+    models (evaluation, decoding, vis); while sampling, it only serves the draw of
+    the analysis of a word whose probability was just computed by the PYP above."""
+    generation = 0 # bumped by invalidate()
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = ProbCache.generation
+        self.hits = self.misses = 0
+
+    @classmethod
+    def invalidate(cls):
+        cls.generation += 1
+
+    def get(self, key):
+        if self.generation != ProbCache.generation:
+            self.entries.clear()
+            self.generation = ProbCache.generation
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if self.size == 0: return
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __getstate__(self):
+        return {'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
+    def __repr__(self):
+        lookups = self.hits + self.misses
+        return 'Cache(hits={0:.1%} of {1})'.format(self.hits/float(lookups or 1), lookups)
+
+class AnalysisTable:
+    """Flat copy of an analyses dict: word k has the analyses
+    (stems[i], patterns[i]) for offsets[k] <= i < offsets[k+1],
+    in the order of analyses[k]"""
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.stems = np.zeros(0, dtype=np.int32)
+        self.patterns = np.zeros(0, dtype=np.int32)
+        self.refresh()
+
+    @property
+    def n_words(self):
+        return len(self.offsets) - 1
+
+    def refresh(self):
+        # Compile words added to the analyses dict since the last refresh
+        if not self.analyses: return
+        if self.n_words == 0 and hasattr(self.analyses, 'csr'): # memory-mapped analyses
+            csr = self.analyses.csr()
+            if csr is not None:
+                self.offsets, self.stems, self.patterns = csr
+        words = xrange(self.n_words, max(self.analyses) + 1)
+        if not words: return
+        new = [self.analyses.get(w, ()) for w in words]
+        lengths = np.fromiter((len(analyses) for analyses in new), np.int64, len(new))
+        stems = np.fromiter((a.stem for analyses in new for a in analyses),
+                np.int32, lengths.sum())
+        patterns = np.fromiter((a.pattern for analyses in new for a in analyses),
+                np.int32, lengths.sum())
+        self.offsets = np.concatenate((self.offsets, self.offsets[-1] + np.cumsum(lengths)))
+        self.stems = np.concatenate((self.stems, stems))
+        self.patterns = np.concatenate((self.patterns, patterns))
+
+    def span(self, k):
+        if k >= self.n_words:
+            self.refresh()
+        return self.offsets[k], self.offsets[k+1]
+
+    def prune(self, keep):
+        """Keep only the analyses (rows) where keep is True, in the table and in
+        the analyses dict"""
+        kept = np.zeros(len(keep)+1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        offsets = kept[self.offsets]
+        for k in np.flatnonzero(np.diff(offsets) < np.diff(self.offsets)):
+            lo, hi = self.offsets[k], self.offsets[k+1]
+            self.analyses[k] = [analysis for analysis, kept_analysis
+                    in izip(self.analyses[k], keep[lo:hi]) if kept_analysis]
+        self.offsets = offsets
+        self.stems = self.stems[keep]
+        self.patterns = self.patterns[keep]
+
+    def analyses_per_word(self):
+        lengths = np.diff(self.offsets)
+        return lengths.sum() / float(np.count_nonzero(lengths) or 1)
+
+    def __repr__(self):
+        return 'AnalysisTable(#words={self.n_words}, #analyses={n})'.format(self=self,
+                n=len(self.stems))
+
+class PackedPatterns:
+    """Morphemes of all the patterns of a vocabulary packed into one array:
+    pattern p is morphemes[offsets[p]:offsets[p+1]], of length lengths[p]"""
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.morphemes = np.zeros(0, dtype=np.int32)
+        self.refresh()
+
+    def refresh(self):
+        # Pack patterns added to the vocabulary since the last refresh
+        if len(self.lengths) == len(self.vocabulary): return
+        if hasattr(self.vocabulary, 'packed'): # share the arrays of a PatternVocabulary
+            self.offsets, self.morphemes = self.vocabulary.packed()
+            self.lengths = np.diff(self.offsets)
+            return
+        lengths, morphemes = pack_patterns(self.vocabulary, len(self.lengths))
+        self.offsets = np.concatenate((self.offsets, self.offsets[-1] + np.cumsum(lengths)))
+        self.lengths = np.concatenate((self.lengths, lengths))
+        self.morphemes = np.concatenate((self.morphemes, morphemes))
+
+    def lengths_of(self, patterns):
+        patterns = np.asarray(patterns, dtype=np.int64)
+        if len(patterns) and patterns.max() >= len(self.lengths):
+            self.refresh()
+        return self.lengths[patterns]
+
+    def gather(self, patterns):
+        """-> (lengths, morphemes of all patterns, start of each pattern in morphemes)"""
+        lengths = self.lengths_of(patterns)
+        positions, heads = gather_segments(self.offsets, patterns)
+        return lengths, self.morphemes[positions], heads
+
+def length_log_probs(length_model, lengths):
+    """log p(#morphemes - 1) for patterns of the given lengths (-inf if empty)"""
+    values, index = np.unique(lengths, return_inverse=True)
+    return np.array([safe_log(length_model.prob(n-1)) if n > 0 else float('-inf')
+        for n in values.tolist()])[index]
 
 class UniformUnigramPattern:
     def __init__(self, K, gamma, delta, pattern_vocabulary):
         self.morpheme_model = Uniform(K-3) # -START, -STOP, -STEM
         self.length_model = GammaPoisson(gamma, delta)
         self.vocabulary = pattern_vocabulary
+        self.packed = PackedPatterns(pattern_vocabulary)
 
     def increment(self, pattern):
-        n_morphemes = len(self.vocabulary[pattern])
-        self.morpheme_model.count += n_morphemes-1
-        self.length_model.increment(n_morphemes-1)
+        self.increment_many((pattern,))
 
     def decrement(self, pattern):
-        n_morphemes = len(self.vocabulary[pattern])
-        self.morpheme_model.count -= n_morphemes-1
-        self.length_model.decrement(n_morphemes-1)
+        self.decrement_many((pattern,))
+
+    def increment_many(self, patterns):
+        lengths = self.packed.lengths_of(patterns)
+        self.morpheme_model.count += int((lengths-1).sum())
+        for n_morphemes in lengths.tolist():
+            self.length_model.increment(n_morphemes-1)
+
+    def decrement_many(self, patterns):
+        lengths = self.packed.lengths_of(patterns)
+        self.morpheme_model.count -= int((lengths-1).sum())
+        for n_morphemes in lengths.tolist():
+            self.length_model.decrement(n_morphemes-1)
 
     def prob(self, pattern):
-        n_morphemes = len(self.vocabulary[pattern])
-        morpheme_prob = 1./self.morpheme_model.K
-        return (morpheme_prob**(n_morphemes-1) *
-                self.length_model.prob(n_morphemes-1))
+        return math.exp(self.log_prob(pattern))
+
+    def log_prob(self, pattern):
+        return float(self.log_prob_many((pattern,))[0])
+
+    def prob_many(self, patterns):
+        return np.exp(self.log_prob_many(patterns))
+
+    def log_prob_many(self, patterns):
+        lengths = self.packed.lengths_of(patterns)
+        return (-(lengths-1) * math.log(self.morpheme_model.K)
+                + length_log_probs(self.length_model, lengths))
 
     def log_likelihood(self, full=False):
         return (self.morpheme_model.log_likelihood(full)
@@ -38,74 +372,199 @@ class UniformUnigramPattern:
     def resample_hyperparemeters(self, n_iter):
         return self.morpheme_model.resample_hyperparemeters(n_iter)
 
+    def grow(self, K, pattern_vocabulary):
+        self.morpheme_model.K = K-3
+        self.vocabulary = pattern_vocabulary
+        self.packed = PackedPatterns(pattern_vocabulary)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['packed']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.packed = PackedPatterns(self.vocabulary)
+
     def __repr__(self):
         return ('UniformUnigram(length ~ {self.length_model},'
                 ' morph ~ {self.morpheme_model})').format(self=self)
 
 class PoissonUnigramPattern:
     def __init__(self, K, morpheme_prior, gamma, delta, pattern_vocabulary):
-        self.morpheme_model = DirichletMultinomial(K-2, morpheme_prior) # -START, -STOP
+        self.prior = morpheme_prior
+        self.prior.tie(self)
+        self.K = K-2 # -START, -STOP
+        self.counts = np.zeros(self.K, dtype=np.int32) # morpheme m is counts[m-2]
+        self.N = 0
         self.length_model = GammaPoisson(gamma, delta)
         self.vocabulary = pattern_vocabulary
+        self.packed = PackedPatterns(pattern_vocabulary)
 
     def increment(self, pattern):
-        morphemes = self.vocabulary[pattern]
-        for morpheme in morphemes:
-            self.morpheme_model.increment(morpheme-2)
-        self.length_model.increment(len(morphemes)-1)
+        self.increment_many((pattern,))
 
     def decrement(self, pattern):
-        morphemes = self.vocabulary[pattern]
-        for morpheme in morphemes:
-            self.morpheme_model.decrement(morpheme-2)
-        self.length_model.decrement(len(morphemes)-1)
+        self.decrement_many((pattern,))
+
+    def increment_many(self, patterns):
+        lengths, morphemes, _ = self.packed.gather(patterns)
+        np.add.at(self.counts, morphemes-2, 1)
+        self.N += len(morphemes)
+        for n_morphemes in lengths.tolist():
+            self.length_model.increment(n_morphemes-1)
+
+    def decrement_many(self, patterns):
+        lengths, morphemes, _ = self.packed.gather(patterns)
+        np.subtract.at(self.counts, morphemes-2, 1)
+        self.N -= len(morphemes)
+        for n_morphemes in lengths.tolist():
+            self.length_model.decrement(n_morphemes-1)
 
     def prob(self, pattern):
-        morphemes = self.vocabulary[pattern]
-        return (prod(self.morpheme_model.prob(m) for m in morphemes) *
-                self.length_model.prob(len(morphemes)-1))
+        return math.exp(self.log_prob(pattern))
+
+    def log_prob(self, pattern):
+        return float(self.log_prob_many((pattern,))[0])
+
+    def prob_many(self, patterns):
+        return np.exp(self.log_prob_many(patterns))
+
+    def log_prob_many(self, patterns):
+        lengths, morphemes, heads = self.packed.gather(patterns)
+        alpha = self.prior.x
+        morpheme_log_probs = (np.log(alpha + self.counts[morphemes-2])
+                - math.log(self.N + self.K * alpha))
+        log_probs = np.zeros(len(lengths))
+        full = lengths > 0
+        if full.any():
+            log_probs[full] = np.add.reduceat(morpheme_log_probs, heads[full])
+        return log_probs + length_log_probs(self.length_model, lengths)
 
     def log_likelihood(self, full=False):
-        return (self.morpheme_model.log_likelihood(full)
-                + self.length_model.log_likelihood(full))
+        alpha = self.prior.x
+        counts = self.counts[self.counts > 0]
+        ll = (math.lgamma(self.K * alpha) - math.lgamma(self.K * alpha + self.N)
+                + lgamma_sum(alpha, counts) - len(counts) * math.lgamma(alpha))
+        if full:
+            ll += self.prior.log_likelihood()
+        return ll + self.length_model.log_likelihood(full)
 
     def resample_hyperparemeters(self, n_iter):
-        return self.morpheme_model.resample_hyperparemeters(n_iter)
+        return self.prior.resample(n_iter)
+
+    def grow(self, K, pattern_vocabulary):
+        counts = np.zeros(K-2, dtype=np.int32)
+        counts[:self.K] = self.counts
+        self.K, self.counts = K-2, counts
+        self.vocabulary = pattern_vocabulary
+        self.packed = PackedPatterns(pattern_vocabulary)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['packed']
+        return state
+
+    def __setstate__(self, state):
+        legacy = state.pop('morpheme_model', None)
+        self.__dict__.update(state)
+        if legacy is not None: # pickled with a DirichletMultinomial over morphemes
+            self.prior = legacy.prior
+            self.K = legacy.K
+            self.counts = np.array(legacy.count, dtype=np.int32)
+            self.N = int(self.counts.sum())
+            self.prior.tied_distributions = [d for d in self.prior.tied_distributions
+                    if d is not legacy]
+            self.prior.tie(self)
+        self.packed = PackedPatterns(self.vocabulary)
 
     def __repr__(self):
         return ('PoissonUnigram(length ~ {self.length_model},'
-                ' morph ~ {self.morpheme_model})').format(self=self)
+                ' morph ~ Mult(K={self.K}) ~ Dir(alpha ~ {self.prior}))').format(self=self)
 
 class BigramPattern:
     def __init__(self, K, prior, pattern_vocabulary):
         self.prior = prior
-        self.morpheme_models = [DirichletMultinomial(K, prior) for _ in range(K)]
+        self.prior.tie(self)
+        self.K = K
+        self.counts = np.zeros((K, K), dtype=np.int32) # morpheme bigram counts
+        self.totals = np.zeros(K, dtype=np.int32) # row sums of counts
         self.vocabulary = pattern_vocabulary
-
-    def _unigrams(self, pattern):
-        yield START
-        for m in self.vocabulary[pattern]:
-            yield m
-        yield STOP
-
-    def _bigrams(self, pattern):
-        a, b = tee(self._unigrams(pattern))
-        next(b)
-        return izip(a, b)
+        self._pack()
+
+    def _pack(self):
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._x = self._y = np.zeros(0, dtype=np.int32)
+        self._refresh()
+
+    def _refresh(self):
+        # Pack START+pattern+STOP bigrams of patterns added to the vocabulary
+        n_packed = len(self._offsets) - 1
+        if n_packed == len(self.vocabulary): return
+        lengths, morphemes = pack_patterns(self.vocabulary, n_packed)
+        ends = np.cumsum(lengths + 2)
+        unigrams = np.empty(ends[-1], dtype=np.int32)
+        unigrams[:] = STOP
+        unigrams[ends - lengths - 2] = START
+        body = np.ones(ends[-1], dtype=bool)
+        body[ends - lengths - 2] = body[ends - 1] = False
+        unigrams[body] = morphemes
+        # Bigrams span consecutive unigrams of the same pattern
+        inner = np.ones(ends[-1] - 1, dtype=bool)
+        inner[ends[:-1] - 1] = False
+        self._x = np.concatenate((self._x, unigrams[:-1][inner]))
+        self._y = np.concatenate((self._y, unigrams[1:][inner]))
+        self._offsets = np.concatenate((self._offsets,
+            self._offsets[-1] + np.cumsum(lengths + 1)))
+
+    def _bigrams(self, patterns):
+        if len(patterns) and np.max(patterns) >= len(self._offsets) - 1:
+            self._refresh()
+        positions, heads = gather_segments(self._offsets, patterns)
+        return self._x[positions], self._y[positions], heads
 
     def increment(self, pattern):
-        for x, y in self._bigrams(pattern):
-            self.morpheme_models[x].increment(y)
+        self.increment_many((pattern,))
 
     def decrement(self, pattern):
-        for x, y in self._bigrams(pattern):
-            self.morpheme_models[x].decrement(y)
+        self.decrement_many((pattern,))
+
+    def increment_many(self, patterns):
+        x, y, _ = self._bigrams(patterns)
+        np.add.at(self.counts, (x, y), 1)
+        np.add.at(self.totals, x, 1)
+
+    def decrement_many(self, patterns):
+        x, y, _ = self._bigrams(patterns)
+        np.subtract.at(self.counts, (x, y), 1)
+        np.subtract.at(self.totals, x, 1)
+
+    def _bigram_probs(self, x, y):
+        alpha = self.prior.x
+        return (alpha + self.counts[x, y]) / (self.totals[x] + self.K * alpha)
 
     def prob(self, pattern):
-        return prod(self.morpheme_models[x].prob(y) for x, y in self._bigrams(pattern))
+        return float(self.prob_many((pattern,))[0])
+
+    def log_prob(self, pattern):
+        return float(self.log_prob_many((pattern,))[0])
+
+    def prob_many(self, patterns):
+        x, y, heads = self._bigrams(patterns)
+        return np.multiply.reduceat(self._bigram_probs(x, y), heads)
+
+    def log_prob_many(self, patterns):
+        x, y, heads = self._bigrams(patterns)
+        return np.add.reduceat(np.log(self._bigram_probs(x, y)), heads)
 
     def log_likelihood(self, full=False):
-        ll = sum(m.log_likelihood() for m in self.morpheme_models)
+        alpha = self.prior.x
+        totals = self.totals[self.totals > 0]
+        counts = self.counts[self.counts > 0]
+        ll = (len(totals) * math.lgamma(self.K * alpha)
+                - lgamma_sum(self.K * alpha, totals)
+                + lgamma_sum(alpha, counts)
+                - len(counts) * math.lgamma(alpha))
         if full:
             ll += self.prior.log_likelihood()
         return ll
@@ -113,44 +572,229 @@ class BigramPattern:
     def resample_hyperparemeters(self, n_iter):
         return self.prior.resample(n_iter)
 
+    def grow(self, K, pattern_vocabulary):
+        counts = np.zeros((K, K), dtype=np.int32)
+        counts[:self.K, :self.K] = self.counts
+        totals = np.zeros(K, dtype=np.int32)
+        totals[:self.K] = self.totals
+        self.K, self.counts, self.totals = K, counts, totals
+        self.vocabulary = pattern_vocabulary
+        self._pack()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for packed in ('_offsets', '_x', '_y'):
+            del state[packed]
+        return state
+
+    def __setstate__(self, state):
+        legacy = state.pop('morpheme_models', None)
+        self.__dict__.update(state)
+        if legacy is not None: # pickled with one DirichletMultinomial per morpheme
+            self.K = len(legacy)
+            self.counts = np.array([m.count for m in legacy], dtype=np.int32)
+            self.totals = self.counts.sum(axis=1).astype(np.int32)
+            legacy_ids = set(map(id, legacy))
+            self.prior.tied_distributions = [d for d in self.prior.tied_distributions
+                    if id(d) not in legacy_ids]
+            self.prior.tie(self)
+        self._pack()
+
     def __repr__(self):
-        return 'Bigram(stem\'|stem ~ Mult(K={K}) ~ Dir(alpha ~ {self.prior}))'.format(self=self, K = len(self.morpheme_models))
+        return 'Bigram(stem\'|stem ~ Mult(K={self.K}) ~ Dir(alpha ~ {self.prior}))'.format(self=self)
 
 class MorphoProcess:
-    def __init__(self, stem_model, pattern_model, analyses):
+    def __init__(self, stem_model, pattern_model, analyses, cache_size=100000):
         self.stem_model = stem_model
         self.pattern_model = pattern_model
-        self.analyses = analyses
-        self.assignments = defaultdict(list)
+        self.table = (analyses if isinstance(analyses, AnalysisTable)
+                else AnalysisTable(analyses))
+        self.analyses = self.table.analyses
+        self.assignments = {} # word -> number of customers per analysis
+        self.cache = ProbCache(cache_size)
+        self.ll_delta = None # change of the G_s, G_p seating log-likelihoods, when tracked
 
     def increment(self, k):
         # Sample analysis & store assignment
-        i = (0 if len(self.analyses[k]) == 1 else
-                mult_sample((i, self.analysis_prob(analysis))
-                    for i, analysis in enumerate(self.analyses[k])))
-        self.assignments[k].append(i)
-        analysis = self.analyses[k][i]
-        # Increment models
-        self.stem_model.increment(analysis.stem)
-        self.pattern_model.increment(analysis.pattern)
+        lo, hi = self.table.span(k)
+        i = 0 if hi - lo == 1 else log_sample(self.analysis_log_probs(k))
+        if k not in self.assignments:
+            self.assignments[k] = np.zeros(hi - lo, dtype=np.int32)
+        self.assignments[k][i] += 1
+        self._add(lo+i)
 
     def decrement(self, k):
         # Select assigned analysis randomly and remove it
-        analysis = self.analyses[k][remove_random(self.assignments[k])]
-        # Decrement models
-        self.stem_model.decrement(analysis.stem)
-        self.pattern_model.decrement(analysis.pattern)
+        counts = self.assignments[k]
+        i = cumsum_sample(counts)
+        counts[i] -= 1
+        if not counts.any():
+            del self.assignments[k]
+        self._remove(self.table.offsets[k]+i)
+
+    def _add(self, row):
+        stem, pattern = int(self.table.stems[row]), int(self.table.patterns[row])
+        if self.ll_delta is None:
+            self.stem_model.increment(stem)
+            self.pattern_model.increment(pattern)
+        else:
+            stem_state = seating(self.stem_model, stem)
+            pattern_state = seating(self.pattern_model, pattern)
+            self.stem_model.increment(stem)
+            self.pattern_model.increment(pattern)
+            self.ll_delta += seating_delta(stem_state, stem) + seating_delta(pattern_state, pattern)
+        ProbCache.invalidate()
+
+    def _remove(self, row):
+        stem, pattern = int(self.table.stems[row]), int(self.table.patterns[row])
+        if self.ll_delta is None:
+            self.stem_model.decrement(stem)
+            self.pattern_model.decrement(pattern)
+        else:
+            stem_state = seating(self.stem_model, stem)
+            pattern_state = seating(self.pattern_model, pattern)
+            self.stem_model.decrement(stem)
+            self.pattern_model.decrement(pattern)
+            self.ll_delta += seating_delta(stem_state, stem) + seating_delta(pattern_state, pattern)
+        ProbCache.invalidate()
+
+    def track_ll_delta(self):
+        """Start (or restart from 0) tracking the change of the G_s, G_p seating
+        log-likelihoods, for a model keeping a running log-likelihood"""
+        self.ll_delta = 0.0
+
+    def take_ll_delta(self):
+        """-> change of the G_s, G_p seating log-likelihoods since the last call"""
+        delta, self.ll_delta = self.ll_delta, 0.0
+        return delta
+
+    def resample_analyses(self):
+        """Type-based blocked sampling of the analyses of every word type.
+        The moves do not leave the posterior invariant (see resample_type),
+        so the samplers do not run them between sweeps.
+        -> (accepted, proposed) block moves"""
+        accepted = proposed = 0
+        for k in self.assignments.keys():
+            lo, hi = self.table.span(k)
+            if hi - lo == 1: continue
+            accepted += self.resample_type(k, lo)
+            proposed += 1
+        return accepted, proposed
+
+    def resample_type(self, k, lo):
+        """Remove all the customers of word k from the stem and pattern models
+        and redraw their analyses jointly. The new analyses are drawn one customer
+        at a time from the predictive distribution; the move is accepted with the
+        ratio of the products of the sequential normalizers of the new and old
+        assignments. This is an approximate block move: the ratio ignores the
+        table seating of the stem and pattern PYPs, and a rejected move re-adds
+        the old analyses with a fresh seating instead of restoring the old one."""
+        old = self.assignments[k]
+        old_rows = (lo + np.repeat(np.arange(len(old)), old)).tolist()
+        random.shuffle(old_rows)
+        old_lz = 0
+        for row in old_rows:
+            self._remove(row)
+            old_lz += self.log_prob(k)
+        new = np.zeros(len(old), dtype=np.int32)
+        new_rows = []
+        new_lz = 0
+        for _ in xrange(len(old_rows)):
+            log_probs = self.analysis_log_probs(k)
+            new_lz += float(segment_logsumexp(log_probs, np.zeros(1, dtype=np.int64),
+                np.array([len(log_probs)])))
+            i = log_sample(log_probs)
+            new[i] += 1
+            new_rows.append(lo+i)
+            self._add(lo+i)
+        if new_lz < old_lz and random.random() >= math.exp(new_lz - old_lz):
+            for row in new_rows:
+                self._remove(row)
+            for row in old_rows[::-1]:
+                self._add(row)
+            return 0
+        self.assignments[k] = new
+        return 1
+
+    def analysis_log_prob(self, analysis):
+        key = (analysis.stem, analysis.pattern)
+        lp = self.cache.get(key)
+        if lp is None:
+            lp = (item_log_prob(self.stem_model, analysis.stem) +
+                    item_log_prob(self.pattern_model, analysis.pattern))
+            self.cache.put(key, lp)
+        return lp
 
     def analysis_prob(self, analysis):
-        return (self.stem_model.prob(analysis.stem) *
-                self.pattern_model.prob(analysis.pattern))
+        return math.exp(self.analysis_log_prob(analysis))
+
+    def analysis_log_probs(self, k):
+        log_probs = self.cache.get(k)
+        if log_probs is None:
+            lo, hi = self.table.span(k)
+            log_probs = self._log_probs(self.table.stems[lo:hi], self.table.patterns[lo:hi])
+            self.cache.put(k, log_probs)
+        return log_probs
+
+    def analysis_probs(self, k):
+        return np.exp(self.analysis_log_probs(k))
+
+    def _log_probs(self, stems, patterns):
+        # Score each distinct stem and pattern once
+        stems, stem_index = np.unique(stems, return_inverse=True)
+        patterns, pattern_index = np.unique(patterns, return_inverse=True)
+        return (batch_log_prob(self.stem_model, stems)[stem_index]
+                + batch_log_prob(self.pattern_model, patterns)[pattern_index])
 
     def prob(self, k):
-        return sum(self.analysis_prob(analysis) for analysis in self.analyses[k])
+        return float(self.analysis_probs(k).sum())
+
+    def log_prob(self, k):
+        log_probs = self.analysis_log_probs(k)
+        return float(segment_logsumexp(log_probs, np.zeros(1, dtype=np.int64),
+            np.array([len(log_probs)])))
+
+    def log_prob_many(self, ks):
+        ks = np.asarray(ks, dtype=np.int64)
+        if len(ks) and ks.max() >= self.table.n_words:
+            self.table.refresh()
+        positions, heads = gather_segments(self.table.offsets, ks)
+        lengths = self.table.offsets[ks+1] - self.table.offsets[ks]
+        log_probs = self._log_probs(self.table.stems[positions], self.table.patterns[positions])
+        return segment_logsumexp(log_probs, heads, lengths)
 
     def decode(self, k):
-        return max((self.analysis_prob(analysis), analysis)
-            for analysis in self.analyses[k])
+        log_probs = self.analysis_log_probs(k)
+        i = log_probs.argmax()
+        return math.exp(log_probs[i]), self.analyses[k][i]
+
+    def decode_many(self, ks):
+        """-> (best, best_probs, posteriors, heads) for the words ks:
+        best[j] indexes the most probable analysis of ks[j] in analyses[ks[j]]
+        (-1 if it has none), best_probs[j] is its probability and
+        posteriors[heads[j]:heads[j]+len(analyses[ks[j]])] its analysis posterior"""
+        ks = np.asarray(ks, dtype=np.int64)
+        if len(ks) and ks.max() >= self.table.n_words:
+            self.table.refresh()
+        positions, heads = gather_segments(self.table.offsets, ks)
+        lengths = self.table.offsets[ks+1] - self.table.offsets[ks]
+        log_probs = self._log_probs(self.table.stems[positions], self.table.patterns[positions])
+        log_z = segment_logsumexp(log_probs, heads, lengths)
+        with np.errstate(invalid='ignore'):
+            posteriors = np.exp(log_probs - np.repeat(log_z, lengths))
+        best = np.empty(len(ks), dtype=np.int64)
+        best.fill(-1)
+        best_log_probs = np.empty(len(ks))
+        best_log_probs.fill(float('-inf'))
+        full = lengths > 0
+        if full.any():
+            top = np.maximum.reduceat(log_probs, heads[full])
+            # First position reaching the maximum of each word
+            rank = np.arange(len(log_probs))
+            rank[log_probs < np.repeat(top, lengths[full])] = len(log_probs)
+            best[full] = np.minimum.reduceat(rank, heads[full]) - heads[full]
+            best_log_probs[full] = top
+        return best, np.exp(best_log_probs), posteriors, heads
 
     def log_likelihood(self, full=False):
         return (self.stem_model.log_likelihood(full=full)
@@ -161,20 +805,40 @@ class MorphoProcess:
         a1, r1 = self.stem_model.resample_hyperparemeters(n_iter)
         logging.info('Resampling pattern model hyperparameters')
         a2, r2 = self.pattern_model.resample_hyperparemeters(n_iter)
+        ProbCache.invalidate()
         return (a1+a2, r1+r2)
 
+    def grow(self, analyses):
+        """Switch to an analyses dict extended with new words; the analyses of the
+        words already in the table must be unchanged"""
+        self.table.analyses = self.analyses = analyses
+        self.table.refresh()
+        ProbCache.invalidate()
+
     def __repr__(self):
         return ('MorphoProcess(#words={N} | stem ~ {self.stem_model}; '
-                'pattern ~ {self.pattern_model})'
-                ).format(self=self, N=sum(map(len, self.assignments.itervalues())))
+                'pattern ~ {self.pattern_model} | {self.cache})'
+                ).format(self=self, N=sum(c.sum() for c in self.assignments.itervalues()))
+
+    def __setstate__(self, state):
+        state.setdefault('ll_delta', None)
+        self.__dict__.update(state)
+        if isinstance(self.assignments, defaultdict): # one analysis index per customer
+            self.assignments = dict((k, np.bincount(assignments,
+                minlength=len(self.analyses[k])).astype(np.int32))
+                for k, assignments in self.assignments.iteritems() if assignments)
+        if 'table' not in state: # pickled before analyses were compiled
+            self.table = AnalysisTable(self.analyses)
+        if 'cache' not in state:
+            self.cache = ProbCache(100000)
 
 class SwitchingMorphoProcess:
-    def __init__(self, word_model, stem_model, pattern_model, analyses):
+    def __init__(self, word_model, stem_model, pattern_model, analyses, cache_size=100000):
         self.word_model = word_model
-        self.mp = MorphoProcess(stem_model, pattern_model, analyses)
+        self.mp = MorphoProcess(stem_model, pattern_model, analyses, cache_size)
         self.switch_model = BetaBernouilli(1.0, 1e6)
         self.analyses = analyses
-        self.switches = defaultdict(list)
+        self.switches = np.zeros((len(analyses), 2), dtype=np.int32) # word -> (#mp, #word)
 
     def increment(self, k):
         p_word, p_mp = self.probs(k)
@@ -186,10 +850,16 @@ class SwitchingMorphoProcess:
             self.mp.increment(k)
             switch = False
         self.switch_model.increment(switch)
-        self.switches[k].append(switch)
+        if k >= len(self.switches):
+            switches = np.zeros((max(k+1, 2*len(self.switches)), 2), dtype=np.int32)
+            switches[:len(self.switches)] = self.switches
+            self.switches = switches
+        self.switches[k, int(switch)] += 1
 
     def decrement(self, k):
-        switch = remove_random(self.switches[k])
+        n_mp, n_word = self.switches[k]
+        switch = random.random() * (n_mp + n_word) < n_word
+        self.switches[k, int(switch)] -= 1
         if switch:
             self.word_model.decrement(k)
         else:
@@ -199,7 +869,8 @@ class SwitchingMorphoProcess:
     def probs(self, k):
         p = self.switch_model.p
         p_word = p * self.word_model.prob(k)
-        p_mp = 0 if len(self.analyses[k]) == 0 else (1 - p) * self.mp.prob(k)
+        lo, hi = self.mp.table.span(k)
+        p_mp = 0 if hi == lo else (1 - p) * self.mp.prob(k)
         return (p_word, p_mp)
 
     def prob(self, k):
@@ -217,6 +888,16 @@ class SwitchingMorphoProcess:
         a2, r2 = self.mp.resample_hyperparemeters(n_iter)
         return (a1+a2, r1+r2)
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.switches, defaultdict): # one boolean per customer
+            switches = np.zeros((max(len(self.analyses), max(self.switches or [-1])+1), 2),
+                    dtype=np.int32)
+            for k, word_switches in self.switches.iteritems():
+                n_word = sum(word_switches)
+                switches[k] = (len(word_switches) - n_word, n_word)
+            self.switches = switches
+
     def __repr__(self):
         return ('Switching[{self.word_model}+{self.mp}'
                 '|switch={self.switch_model}]').format(self=self)
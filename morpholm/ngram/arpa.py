@@ -1,10 +1,10 @@
 import argparse
 import logging
-import cPickle
 from vpyp.ngram.arpa import print_arpa
 from vpyp.corpus import Corpus
 from ..analyze import load_analyses
 from .eval import fix_model
+from ..modelfile import load_model
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -13,6 +13,9 @@ def main():
     parser.add_argument('--backend', help='analyzer backend (foma/xfst/pymorphy/xerox)',
             default='foma')
     parser.add_argument('--analyzer', help='analyzer option')
+    parser.add_argument('--cache', help='persistent analysis cache (SQLite database)')
+    parser.add_argument('--jobs', help='number of parallel analysis processes',
+            type=int, default=1)
     parser.add_argument('--addnull', help='add null analysis', action='store_true')
     parser.add_argument('--vocab', help='test corpus vocabulary (default: training vocabulary)')
     parser.add_argument('--model', help='trained model', required=True)
@@ -20,8 +23,7 @@ def main():
     args = parser.parse_args()
 
     logging.info('Loading model')
-    with open(args.model) as model_file:
-        model = cPickle.load(model_file)
+    model = load_model(args.model)
 
     fix_model(model)
 
@@ -32,10 +34,12 @@ def main():
             vocab_corpus = Corpus(vocab, model.vocabulary)
         load_analyses(vocab_corpus, model)
 
-        from ..analyzers import all_analyzers
-        analyzer = all_analyzers[args.backend](args.analyzer)
+        from ..analyzers import load_analyzer
+        analyzer = load_analyzer(args.backend, args.analyzer, args.cache, args.jobs)
         logging.info('Analyzing vocabulary words using %s', analyzer)
         analyzer.analyze_corpus(vocab_corpus, args.addnull)
+        if analyzer.cache:
+            analyzer.cache.log_stats()
 
         vocabulary = set(seg[0] for seg in vocab_corpus.segments)
     else:
@@ -0,0 +1,65 @@
+import argparse
+import logging
+import numpy as np
+from ..models import SwitchingMorphoProcess
+from ..modelfile import load_model
+
+def morpho_process(model):
+    mp = model.backoff
+    return mp.mp if isinstance(mp, SwitchingMorphoProcess) else mp
+
+def decode_vocabulary(mp, n_words, batch_size):
+    """Decode words 0..n_words-1 in batches -> (best, best_probs, posteriors)"""
+    best, best_probs, posteriors = [], [], []
+    for start in xrange(0, n_words, batch_size):
+        ks = np.arange(start, min(start + batch_size, n_words))
+        b, p, post, _ = mp.decode_many(ks)
+        best.append(b)
+        best_probs.append(p)
+        posteriors.append(post)
+        logging.info('Decoded %d/%d words', ks[-1]+1, n_words)
+    return np.concatenate(best), np.concatenate(best_probs), np.concatenate(posteriors)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Decode the vocabulary of an n-gram model')
+    parser.add_argument('--model', help='trained model', required=True)
+    parser.add_argument('--npy', help='write PREFIX.{best,prob,posterior,offsets}.npy'
+            ' instead of TSV')
+    parser.add_argument('--batch', help='number of words decoded at once', type=int,
+            default=100000)
+    args = parser.parse_args()
+
+    logging.info('Loading model')
+    model = load_model(args.model)
+    mp = morpho_process(model)
+
+    n_words = len(model.vocabulary)
+    best, best_probs, posteriors = decode_vocabulary(mp, n_words, args.batch)
+
+    if args.npy:
+        np.save(args.npy+'.best.npy', best)
+        np.save(args.npy+'.prob.npy', best_probs)
+        np.save(args.npy+'.posterior.npy', posteriors)
+        np.save(args.npy+'.offsets.npy', mp.table.offsets[:n_words+1])
+        return
+
+    S = model.morpheme_vocabulary['__STEM__']
+    def get_analysis(analysis):
+        stem = model.stem_vocabulary[analysis.stem]
+        pattern = model.pattern_vocabulary[analysis.pattern]
+        return '+'.join((stem if m == S else model.morpheme_vocabulary[m]) for m in pattern)
+
+    offsets = mp.table.offsets
+    for w, word in enumerate(model.vocabulary):
+        if w < 2 or best[w] < 0: continue # skip START, STOP
+        analyses = mp.analyses[w]
+        posterior = posteriors[offsets[w]:offsets[w+1]]
+        print(u'{0}\t{1}\t{2}\t{3}'.format(word,
+            get_analysis(analyses[best[w]]), best_probs[w],
+            ' '.join(u'{0}:{1:.4f}'.format(get_analysis(analysis), p)
+                for analysis, p in zip(analyses, posterior))).encode('utf8'))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
 import argparse
 import logging
-import cPickle
 from vpyp.corpus import Corpus
 from vpyp.ngram.eval import print_ppl
 from ..analyze import load_analyses
+from ..modelfile import load_model
 
 """"""""""""""""""""""""""""""""""""
 from vpyp.charlm import CharLM
@@ -60,6 +60,9 @@ def main():
     parser.add_argument('--backend', help='analyzer backend (foma/xfst/pymorphy/xerox)',
             default='foma')
     parser.add_argument('--analyzer', help='analyzer option', required=True)
+    parser.add_argument('--cache', help='persistent analysis cache (SQLite database)')
+    parser.add_argument('--jobs', help='number of parallel analysis processes',
+            type=int, default=1)
     parser.add_argument('--addnull', help='add null analysis', action='store_true')
     parser.add_argument('--rmnull', help='remove null analysis', action='store_true')
     parser.add_argument('--model', help='trained model', required=True)
@@ -69,8 +72,7 @@ def main():
     args = parser.parse_args()
 
     logging.info('Loading model')
-    with open(args.model) as model_file:
-        model = cPickle.load(model_file)
+    model = load_model(args.model)
     # fix_model(model)
 
     logging.info('Reading evaluation corpus')
@@ -78,10 +80,12 @@ def main():
         test_corpus = Corpus(test, model.vocabulary)
     load_analyses(test_corpus, model)
 
-    from ..analyzers import all_analyzers
-    analyzer = all_analyzers[args.backend](args.analyzer)
+    from ..analyzers import load_analyzer
+    analyzer = load_analyzer(args.backend, args.analyzer, args.cache, args.jobs)
     logging.info('Analyzing evaluation corpus using %s', analyzer)
     analyzer.analyze_corpus(test_corpus, args.addnull, args.rmnull)
+    if analyzer.cache:
+        analyzer.cache.log_stats()
 
     logging.info('Computing perplexity')
     if args.debug:
@@ -0,0 +1,42 @@
+import logging
+import math
+from vpyp.corpus import ngrams
+from ..models import prune_analyses
+from decode import morpho_process
+
+mh_iter = 100
+
+def trace_values(model):
+    """Quantities compared across chains by the convergence diagnostics"""
+    mp = morpho_process(model)
+    return {'LL': model.log_likelihood(),
+            'stem_d': mp.stem_model.d, 'stem_theta': mp.stem_model.theta,
+            'pattern_d': mp.pattern_model.d, 'pattern_theta': mp.pattern_model.theta}
+
+def run_sampler(model, corpus, n_iter, cb=None, prune=0, burn_in=0,
+        start=0, checkpoint=None, seated=False):
+    n_sentences = len(corpus)
+    n_words = sum(len(sentence) for sentence in corpus)
+    for it in xrange(start, n_iter):
+        logging.info('Iteration %d/%d', it+1, n_iter)
+        for sentence in corpus:
+            for seq in ngrams(sentence, model.order):
+                if it > 0 or seated: model.decrement(seq[:-1], seq[-1])
+                model.increment(seq[:-1], seq[-1])
+        if prune and it == burn_in - 1:
+            before, after = prune_analyses([morpho_process(model)], prune)
+            logging.info('Pruned analyses with posterior < %g: %.2f -> %.2f per word',
+                    prune, before, after)
+        if it % 10 == 9:
+            logging.info('Model: %s', model)
+            ll = model.log_likelihood()
+            ppl = math.exp(-ll / (n_words + n_sentences))
+            logging.info('LL=%.0f ppl=%.3f', ll, ppl)
+        if it % 30 == 29:
+            logging.info('Resampling hyperparameters...')
+            acceptance, rejection = model.resample_hyperparemeters(mh_iter)
+            arate = acceptance / float(acceptance + rejection)
+            logging.info('Metropolis-Hastings acceptance rate: %.4f', arate)
+            logging.info('Model: %s', model)
+        if checkpoint: checkpoint(it+1, model)
+        if cb and cb(it): break
@@ -1,6 +1,8 @@
 import argparse
 import logging
 import cPickle
+from .decode import morpho_process, decode_vocabulary
+from ..modelfile import load_model
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -20,14 +22,13 @@ def main():
         return
 
     logging.info('Loading model')
-    with open(args.model) as model_file:
-        model = cPickle.load(model_file)
-    mp = model.backoff
+    model = load_model(args.model)
+    mp = morpho_process(model)
 
-    for w, word in enumerate(training_corpus.vocabulary):
-        if w < 2: continue # skip START, STOP
-        _, best_stem = max((mp.analysis_prob(analysis), analysis.stem)
-                for analysis in training_corpus.analyses[w])
+    n_words = len(training_corpus.vocabulary)
+    best, _, _ = decode_vocabulary(mp, n_words, 100000)
+    for w in xrange(2, n_words): # skip START, STOP
+        best_stem = mp.analyses[w][best[w]].stem # analyses may have been pruned
         print(training_corpus.stem_vocabulary[best_stem].encode('utf8'))
 
 if __name__ == '__main__':
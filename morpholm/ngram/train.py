@@ -1,3 +1,4 @@
+import os
 import argparse
 import logging
 import cPickle
@@ -6,26 +7,13 @@ from vpyp.charlm import CharLM
 from vpyp.prior import PYPPrior, GammaPrior
 from vpyp.pyp import PYP
 from vpyp.ngram.model import PYPLM
-from vpyp.ngram.train import run_sampler
 from ..models import BigramPattern, UniformUnigramPattern, MorphoProcess, SwitchingMorphoProcess
+from ..chains import run_chains
+from ..checkpoint import Checkpoint, load_checkpoint
+from ..corpusfile import load_corpus, VOCABULARIES
+from sampler import run_sampler, trace_values
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(message)s')
-
-    parser = argparse.ArgumentParser(description='Train n-gram model')
-    parser.add_argument('--train', help='analyzed training corpus', required=True)
-    parser.add_argument('--order', help='order of the model', type=int, required=True)
-    parser.add_argument('--iter', help='number of iterations', type=int, required=True)
-    parser.add_argument('--charlm', help='stem character language model')
-    parser.add_argument('--model', help='type of model', type=int, required=True)
-    parser.add_argument('--switch', help='use switching model', action='store_true')
-    parser.add_argument('--output', help='model output path')
-
-    args = parser.parse_args()
-
-    with open(args.train) as train:
-        training_corpus = cPickle.load(train)
-
+def build_model(args, training_corpus):
     if args.charlm:
         logging.info('Preloading stem CharLM')
         char_lm = CharLM(args.charlm, training_corpus.stem_vocabulary)
@@ -53,23 +41,94 @@ def main():
             word_base = Uniform(len(training_corpus.vocabulary))
         word_model = PYP(word_base, PYPPrior(1.0, 1.0, 1.0, 1.0, 0.8, 1.0))
         mp = SwitchingMorphoProcess(word_model, stem_model, pattern_model,
-                training_corpus.analyses)
+                training_corpus.analyses, args.cache)
     else:
-        mp = MorphoProcess(stem_model, pattern_model, training_corpus.analyses)
+        mp = MorphoProcess(stem_model, pattern_model, training_corpus.analyses, args.cache)
 
-    model = PYPLM(args.order, mp)
+    return PYPLM(args.order, mp)
 
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Train n-gram model')
+    parser.add_argument('--train', help='analyzed training corpus', required=True)
+    parser.add_argument('--order', help='order of the model', type=int, required=True)
+    parser.add_argument('--iter', help='number of iterations', type=int, required=True)
+    parser.add_argument('--charlm', help='stem character language model')
+    parser.add_argument('--model', help='type of model', type=int, required=True)
+    parser.add_argument('--switch', help='use switching model', action='store_true')
+    parser.add_argument('--cache', help='analysis probability cache size', type=int,
+            default=100000)
+    parser.add_argument('--prune', help='after burn-in, drop analyses with a posterior'
+            ' below this threshold', type=float, default=0)
+    parser.add_argument('--burn-in', help='number of iterations before pruning', type=int,
+            default=100)
+    parser.add_argument('--chains', help='number of independent chains run in parallel'
+            ' (the best one is kept)', type=int, default=1)
+    parser.add_argument('--rhat', help='stop the chains when the R-hat of all traced'
+            ' quantities is below this value', type=float, default=1.1)
+    parser.add_argument('--min-ess', help='but not before the effective sample size of'
+            ' the log-likelihood reaches this value', type=float, default=100)
+    parser.add_argument('--checkpoint', help='periodically save the sampler state to this'
+            ' path')
+    parser.add_argument('--checkpoint-interval', help='minutes between checkpoints',
+            type=float, default=5)
+    parser.add_argument('--resume', help='continue training from the checkpoint',
+            action='store_true')
+    parser.add_argument('--output', help='model output path')
+
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    if args.checkpoint and args.chains > 1:
+        parser.error('--checkpoint cannot be used with --chains')
+
+    training_corpus = load_corpus(args.train)
+
+    # The model holds the vocabularies and analyses its MorphoProcess uses, so that
+    # they are saved and checkpointed with it (pruning changes the analyses)
+    if args.resume:
+        state = load_checkpoint(args.checkpoint)
+        model = state['model']
+        start = state['iteration']
+        for name in VOCABULARIES + ('analyses',):
+            setattr(training_corpus, name, getattr(model, name))
+    else:
+        model = build_model(args, training_corpus)
+        start = 0
+        for name in VOCABULARIES + ('analyses',):
+            setattr(model, name, getattr(training_corpus, name))
+
+    def save(path):
+        with open(path, 'w') as f:
+            cPickle.dump(model, f, protocol=-1)
+
+    def train_chain(chain, report):
+        run_sampler(model, training_corpus, args.iter,
+                cb=lambda it: report(it, trace_values(model)),
+                prune=args.prune, burn_in=args.burn_in)
+        if args.output:
+            save('{0}.chain{1}'.format(args.output, chain))
+        return model.log_likelihood()
+
+    if args.chains > 1:
+        logging.info('Training %d chains of order %d', args.chains, args.order)
+        lls = run_chains(train_chain, args.chains, args.rhat, args.min_ess)
+        best = max(xrange(args.chains), key=lambda chain: lls[chain])
+        logging.info('Keeping chain %d (LL=%.0f)', best, lls[best])
+        if args.output:
+            os.rename('{0}.chain{1}'.format(args.output, best), args.output)
+        return
+
+    checkpoint = (Checkpoint(args.checkpoint, args.checkpoint_interval * 60)
+            if args.checkpoint else None)
     logging.info('Training model of order %d', args.order)
-    run_sampler(model, training_corpus, args.iter)
+    run_sampler(model, training_corpus, args.iter, prune=args.prune, burn_in=args.burn_in,
+            start=start, checkpoint=checkpoint)
+    if checkpoint: checkpoint.wait()
 
     if args.output:
-        model.vocabulary = training_corpus.vocabulary
-        model.stem_vocabulary = training_corpus.stem_vocabulary
-        model.morpheme_vocabulary = training_corpus.morpheme_vocabulary
-        model.pattern_vocabulary = training_corpus.pattern_vocabulary
-        model.analyses = training_corpus.analyses
-        with open(args.output, 'w') as f:
-            cPickle.dump(model, f, protocol=-1)
+        save(args.output)
 
 if __name__ == '__main__':
     main()
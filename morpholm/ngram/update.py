@@ -0,0 +1,78 @@
+import argparse
+import logging
+import random
+import cPickle
+from vpyp.prob import Uniform
+from vpyp.corpus import ngrams
+from ..models import SwitchingMorphoProcess, grow_base
+from ..corpusfile import load_corpus
+from decode import morpho_process
+from sampler import run_sampler
+
+def grow_model(model, corpus):
+    """Extend the base distributions of a trained model to the vocabularies of
+    a corpus analyzed with analyze.py --model"""
+    word_model = model.backoff
+    if isinstance(word_model, SwitchingMorphoProcess):
+        grow_base(word_model.word_model, corpus.vocabulary)
+        word_model.analyses = corpus.analyses
+    mp = morpho_process(model)
+    mp.grow(corpus.analyses)
+    grow_base(mp.stem_model, corpus.stem_vocabulary)
+    pattern_base = mp.pattern_model.base
+    if isinstance(pattern_base, Uniform):
+        grow_base(pattern_base, corpus.pattern_vocabulary)
+    else:
+        pattern_base.grow(len(corpus.morpheme_vocabulary), corpus.pattern_vocabulary)
+    model.vocabulary = corpus.vocabulary
+    model.stem_vocabulary = corpus.stem_vocabulary
+    model.morpheme_vocabulary = corpus.morpheme_vocabulary
+    model.pattern_vocabulary = corpus.pattern_vocabulary
+    model.analyses = corpus.analyses
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Continue training an n-gram model'
+            ' on new data')
+    parser.add_argument('--model', help='trained model', required=True)
+    parser.add_argument('--train', help='new training corpus, analyzed with'
+            ' analyze.py --model', required=True)
+    parser.add_argument('--iter', help='number of iterations', type=int, required=True)
+    parser.add_argument('--replay', help='previous training corpus, to resample'
+            ' along with the new data')
+    parser.add_argument('--replay-fraction', help='fraction of the previous corpus'
+            ' to resample', type=float, default=0.1)
+    parser.add_argument('--output', help='model output path', required=True)
+
+    args = parser.parse_args()
+
+    with open(args.model) as model_file:
+        model = cPickle.load(model_file)
+    training_corpus = load_corpus(args.train)
+
+    logging.info('Extending model to %d words / %d stems / %d patterns',
+            len(training_corpus.vocabulary), len(training_corpus.stem_vocabulary),
+            len(training_corpus.pattern_vocabulary))
+    grow_model(model, training_corpus)
+
+    logging.info('Adding %d sentences to the model', len(training_corpus))
+    for sentence in training_corpus:
+        for seq in ngrams(sentence, model.order):
+            model.increment(seq[:-1], seq[-1])
+
+    sentences = list(training_corpus)
+    if args.replay:
+        replay_corpus = list(load_corpus(args.replay))
+        n_replay = int(len(replay_corpus) * args.replay_fraction)
+        logging.info('Replaying %d previous sentences', n_replay)
+        sentences += random.sample(replay_corpus, n_replay)
+
+    logging.info('Model: %s', model)
+    run_sampler(model, sentences, args.iter, seated=True)
+
+    with open(args.output, 'w') as f:
+        cPickle.dump(model, f, protocol=-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import random
+import multiprocessing
+import numpy as np
+
+def make_shards(offsets, n_workers):
+    """Split segments into contiguous ranges with about as many tokens each"""
+    n_segments = len(offsets) - 1
+    bounds = np.searchsorted(offsets, np.linspace(0, offsets[-1], n_workers+1))
+    bounds[0], bounds[-1] = 0, n_segments
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])
+            if start < end]
+
+# State inherited by forked workers
+_snapshot = None
+
+def _run(job):
+    worker, shard, seed = job
+    random.seed(seed)
+    np.random.seed(seed)
+    return worker(_snapshot, shard)
+
+def fork_map(worker, state, shards, seed):
+    """Run worker(state, shard) for each shard in a forked process, where state
+    is a copy-on-write snapshot; the i-th worker is seeded with seed+i, so the
+    parent RNG is left untouched"""
+    global _snapshot
+    jobs = [(worker, shard, seed + i) for i, shard in enumerate(shards)]
+    _snapshot = state
+    pool = multiprocessing.Pool(len(jobs))
+    try:
+        return pool.map(_run, jobs)
+    finally:
+        pool.terminate()
+        _snapshot = None
+
+def prior_state(prior):
+    """Sampled values of a hyperparameter prior"""
+    return dict((name, value) for name, value in vars(prior).iteritems()
+            if isinstance(value, float))
+
+def _resample_chains(state, shard):
+    chains, n_iter, seed = state
+    start, end = shard
+    results = []
+    for i in xrange(start, end):
+        random.seed(seed + i)
+        word_model = chains[i]
+        stem_model = word_model.base.stem_model
+        a1, r1 = word_model.resample_hyperparemeters(n_iter) # G_w
+        a2, r2 = stem_model.resample_hyperparemeters(n_iter) # G_s
+        results.append((prior_state(word_model.prior), prior_state(stem_model.prior),
+            (a1+a2, r1+r2)))
+    return results
+
+def resample_chains(chains, n_iter, n_workers=1):
+    """Resample the G_w and G_s hyperparameters of independent PYP(MP) chains
+    -> (accepted, rejected); each chain is seeded from its index, so the result
+    does not depend on n_workers"""
+    state = (chains, n_iter, random.randrange(2**31))
+    shards = make_shards(np.arange(len(chains)+1), n_workers)
+    if n_workers == 1 or not shards:
+        rng_state = random.getstate()
+        results = [_resample_chains(state, shard) for shard in shards]
+        random.setstate(rng_state)
+    else:
+        results = fork_map(_resample_chains, state, shards, state[2])
+    accepted = rejected = 0
+    for word_model, (word_prior, stem_prior, (a, r)) in zip(chains,
+            (result for shard in results for result in shard)):
+        vars(word_model.prior).update(word_prior)
+        vars(word_model.base.stem_model.prior).update(stem_prior)
+        accepted += a
+        rejected += r
+    return accepted, rejected
@@ -5,6 +5,7 @@ model_pickle = '/home/vchahune/data/ldmt/lm-exp/tur/models/unigram-mp.1000.pickl
 backend = 'xfst'
 analyzer = '/home/vchahune/data/ldmt/analyzers/tur/rev-generator.fst'
 add_null = False
+analysis_cache = None
 """
 
 # Kinyarwanda
@@ -14,6 +15,7 @@ backend = 'foma'
 analyzer = '/home/vchahune/data/ldmt/analyzers/kin/2012-11-13.fst'
 add_null = False
 annotation_database = '/home/vchahune/data/ldmt/annotation/kin/test.db'
+analysis_cache = '/home/vchahune/data/ldmt/annotation/kin/analyses.db'
 
 """
 # Russian
@@ -23,6 +25,7 @@ backend = 'foma'
 analyzer = '/home/vchahune/data/ldmt/analyzers/rus/rusmorph.fst'
 add_null = True
 annotation_database = '/home/vchahune/data/ldmt/annotation/rus/test.db'
+analysis_cache = '/home/vchahune/data/ldmt/annotation/rus/analyses.db'
 """
 
 users = {'chahuneau': 'victor',
@@ -42,15 +45,14 @@ import logging
 logging.basicConfig(level=logging.INFO)
 
 # Load analyzer
-from morpholm.analyzers import all_analyzers
+from morpholm.analyzers import load_analyzer
 from morpholm.analyzers.analyzer import parse_analysis, Analysis
-analyzer = all_analyzers[backend](analyzer)
+analyzer = load_analyzer(backend, analyzer, analysis_cache)
 logging.info('Using %s for analysis', analyzer)
 
 # Load model
-import cPickle
-with open(model_pickle) as m:
-    model = cPickle.load(m)
+from morpholm.modelfile import load_model
+model = load_model(model_pickle)
 morpho_process = model.backoff
 
 # XXX